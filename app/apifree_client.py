@@ -1,7 +1,14 @@
 from __future__ import annotations
 
+import hashlib
+import re
+import time
+from collections import OrderedDict
 import httpx
-from typing import Any, Dict, List
+import orjson
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from .semantic_cache import SemanticCache
 
 
 def _normalize_base_url(base_url: str) -> str:
@@ -12,26 +19,339 @@ def _normalize_base_url(base_url: str) -> str:
     return base_url.rstrip("/")
 
 
-class ApiFreeClient:
-    def __init__(self, base_url: str, api_key: str, timeout_s: float = 120.0):
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def _parse_seconds(value: Optional[str]) -> Optional[float]:
+    """Retry-After / x-ratelimit-reset: "12", "1.5", "6m0s", "20ms" or a unix timestamp."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        parts = _DURATION_RE.findall(value)
+        if not parts:
+            return None
+        return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+    if seconds > 1e9:  # absolute epoch
+        return max(0.0, seconds - time.time())
+    return seconds
+
+
+class Upstream:
+    """One (base_url, api_key) pair with its load and rate-limit state."""
+
+    def __init__(self, base_url: str, api_key: str, weight: float = 1.0):
         self.base_url = _normalize_base_url(base_url)
         self.api_key = api_key
-        self.timeout_s = timeout_s
+        self.weight = max(weight, 0.01)
+        self.outstanding = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.rate_limited = 0  # 429s seen
+        self.failures = 0
+        self.quota_remaining: Optional[int] = None
+        # stable identity, persisted with jobs: never exposes the key, unlike a key suffix it doesn't collide
+        self.name = f"{self.base_url}#{hashlib.sha256(api_key.encode()).hexdigest()[:12]}"
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until
 
-    def _headers(self) -> Dict[str, str]:
+    def cool_down(self, seconds: float):
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def headers(self) -> Dict[str, str]:
         return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
         }
 
+
+UpstreamSpec = Union[Tuple[str, str], Tuple[str, str, float]]
+
+
+def parse_upstreams(value: str) -> List[UpstreamSpec]:
+    """APIFREE_UPSTREAMS="https://api.apifree.ai|KEY1|2, https://other.host|KEY2" -> [(url, key, weight), ...]"""
+    out: List[UpstreamSpec] = []
+    for item in value.split(","):
+        fields = [f.strip() for f in item.split("|")]
+        if len(fields) < 2 or not fields[0] or not fields[1]:
+            continue
+        weight = float(fields[2]) if len(fields) > 2 and fields[2] else 1.0
+        out.append((fields[0], fields[1], weight))
+    return out
+
+
+class UpstreamPool:
+    """Weighted least-outstanding-requests choice over upstreams that are not cooling down.
+
+    429 / Retry-After, exhausted quota headers (x-ratelimit-remaining*=0 until
+    x-ratelimit-reset*), 402 and transport errors put an upstream on cooldown.
+    """
+
+    def __init__(self, upstreams: Sequence[Upstream], error_cooldown_s: float = 5.0, quota_cooldown_s: float = 600.0):
+        if not upstreams:
+            raise ValueError("ApiFree: no upstreams configured")
+        names = [u.name for u in upstreams]
+        if len(set(names)) != len(names):
+            raise ValueError("ApiFree: the same (base_url, api_key) is configured twice")
+        self.upstreams = list(upstreams)
+        self.error_cooldown_s = error_cooldown_s
+        self.quota_cooldown_s = quota_cooldown_s
+
+    def pick(self, exclude: Iterable[Upstream] = ()) -> Optional[Upstream]:
+        excluded = set(map(id, exclude))
+        candidates = [u for u in self.upstreams if id(u) not in excluded]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        ready = [u for u in candidates if u.available(now)]
+        if not ready:
+            # everyone is cooling down: the one that recovers first beats failing outright
+            return min(candidates, key=lambda u: u.cooldown_until)
+        return min(ready, key=lambda u: (u.outstanding + 1) / u.weight)
+
+    def observe(self, up: Upstream, r: httpx.Response):
+        h = r.headers
+        remaining = h.get("x-ratelimit-remaining-requests") or h.get("x-ratelimit-remaining")
+        if remaining is not None:
+            try:
+                up.quota_remaining = int(float(remaining))
+            except ValueError:
+                up.quota_remaining = None
+            if up.quota_remaining is not None and up.quota_remaining <= 0:
+                reset = _parse_seconds(h.get("x-ratelimit-reset-requests") or h.get("x-ratelimit-reset"))
+                up.cool_down(reset if reset is not None else self.error_cooldown_s)
+
+        if r.status_code == 429:
+            up.rate_limited += 1
+            retry = _parse_seconds(h.get("retry-after"))
+            up.cool_down(retry if retry is not None else self.error_cooldown_s)
+        elif r.status_code == 402:  # payment required: key is out of balance
+            up.cool_down(self.quota_cooldown_s)
+
+    def get(self, name: Optional[str]) -> Optional[Upstream]:
+        return next((u for u in self.upstreams if u.name == name), None) if name else None
+
+    def failed(self, up: Upstream):
+        up.failures += 1
+        up.cool_down(self.error_cooldown_s)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                "upstream": u.name,
+                "weight": u.weight,
+                "outstanding": u.outstanding,
+                "requests": u.requests,
+                "rate_limited": u.rate_limited,
+                "failures": u.failures,
+                "quota_remaining": u.quota_remaining,
+                "cooldown_s": max(0.0, round(u.cooldown_until - now, 1)),
+            }
+            for u in self.upstreams
+        ]
+
+
+def extract_request_id(data: Any) -> Optional[str]:
+    if not isinstance(data, dict):
+        return None
+    for container in (data, data.get("resp_data"), data.get("data")):
+        if isinstance(container, dict):
+            rid = container.get("request_id") or container.get("id")
+            if rid:
+                return str(rid)
+    return None
+
+
+_URL_KEYS = ("url", "image_url", "video_url", "audio_url", "song_url")
+_URL_LIST_KEYS = ("images", "videos", "audios", "urls", "output")
+_DONE_STATUSES = ("done", "success", "succeeded", "completed", "complete")
+_FAILED_STATUSES = ("failed", "error", "canceled", "cancelled")
+
+
+def _first_url(container: Dict[str, Any]) -> Optional[str]:
+    for key in _URL_KEYS:
+        if isinstance(container.get(key), str):
+            return container[key]
+    for key in _URL_LIST_KEYS:
+        items = container.get(key)
+        if isinstance(items, list) and items:
+            first = items[0]
+            if isinstance(first, str):
+                return first
+            if isinstance(first, dict) and isinstance(first.get("url"), str):
+                return first["url"]
+    return None
+
+
+def extract_job_state(data: Any) -> Tuple[str, Optional[str]]:
+    """(status, url) of a submit/result response: status is "done", "failed" or the provider's pending status."""
+    status, url = "", None
+    if isinstance(data, dict):
+        for container in (data, data.get("resp_data"), data.get("data")):
+            if isinstance(container, dict):
+                status = status or str(container.get("status") or "").lower()
+                url = url or _first_url(container)
+    if url or status in _DONE_STATUSES:
+        return "done", url
+    if status in _FAILED_STATUSES:
+        return "failed", None
+    return status or "pending", None
+
+
+class ApiFreeClient:
+    """ApiFree client over one or several (base_url, api_key) upstreams.
+
+    Calls are balanced by weighted least-outstanding-requests. Idempotent calls
+    (chat, result polling by id) fail over to another upstream on 429, 5xx and
+    transport errors; submits only fail over when the upstream surely did not
+    accept the job (429 or connection not established), so a job is never
+    created twice. Result polling goes to the upstream that accepted the submit:
+    store `upstream_for(request_id)` next to the job and pass it back to `*_result`.
+    """
+
+    _RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # a job polled on an upstream that didn't create it: unknown id, or a key that doesn't own it
+    _NOT_OWNER_STATUSES = (401, 403, 404)
+
+    def __init__(self, base_url: str, api_key: str, timeout_s: float = 120.0, semantic_cache: Optional[SemanticCache] = None,
+                 upstreams: Optional[Sequence[UpstreamSpec]] = None, max_pinned_jobs: int = 10000):
+        specs = list(upstreams) if upstreams else [(base_url, api_key)]
+        self.pool = UpstreamPool([Upstream(*spec) for spec in specs])
+        self.base_url = self.pool.upstreams[0].base_url
+        self.api_key = self.pool.upstreams[0].api_key
+        self.timeout_s = timeout_s
+        # opt-in: answers single-prompt chats on cheap models from near-duplicate past prompts
+        self.semantic_cache = semantic_cache
+        # request_id -> upstream that accepted the submit (bounded, oldest dropped)
+        self._pins: "OrderedDict[str, Upstream]" = OrderedDict()
+        self.max_pinned_jobs = max_pinned_jobs
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self.timeout_s)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _send(self, up: Upstream, method: str, path: str, payload: Optional[Dict[str, Any]]) -> httpx.Response:
+        up.outstanding += 1
+        up.requests += 1
+        try:
+            content = orjson.dumps(payload) if payload is not None else None
+            r = await self._http().request(method, f"{up.base_url}{path}", headers=up.headers(), content=content)
+        except httpx.TransportError:
+            self.pool.failed(up)
+            raise
+        finally:
+            up.outstanding -= 1
+        self.pool.observe(up, r)
+        return r
+
+    async def _request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None, idempotent: bool = True,
+                       upstream: Optional[Upstream] = None) -> Tuple[Upstream, httpx.Response]:
+        """Send with failover. A given `upstream` pins the call (no failover)."""
+        if upstream is not None:
+            return upstream, await self._send(upstream, method, path, payload)
+
+        tried: List[Upstream] = []
+        while True:
+            up = self.pool.pick(exclude=tried)
+            tried.append(up)
+            last = len(tried) >= len(self.pool.upstreams)
+            try:
+                r = await self._send(up, method, path, payload)
+            except httpx.TransportError as e:
+                # connect errors: the request never reached the upstream, safe even for submits
+                if last or not (idempotent or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))):
+                    raise
+                continue
+            if last or r.status_code not in self._RETRY_STATUSES:
+                return up, r
+            if r.status_code != 429 and not idempotent:
+                # 5xx on a submit: the job may exist upstream, don't create a duplicate
+                return up, r
+
+    def _pin(self, up: Upstream, data: Any):
+        rid = extract_request_id(data)
+        if rid is None:
+            return
+        self._pins[rid] = up
+        self._pins.move_to_end(rid)
+        while len(self._pins) > self.max_pinned_jobs:
+            self._pins.popitem(last=False)
+
+    def upstream_for(self, request_id: str) -> Optional[str]:
+        """Name of the upstream that accepted the job (right after submit), to be persisted with it."""
+        up = self._pins.get(request_id)
+        return up.name if up is not None else None
+
+    async def _submit(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        up, r = await self._request("POST", path, payload, idempotent=False)
+        r.raise_for_status()
+        data = orjson.loads(r.content)
+        self._pin(up, data)
+        return data
+
+    async def _result(self, path: str, request_id: str, upstream: Optional[str] = None) -> Dict[str, Any]:
+        up = self.pool.get(upstream) or self._pins.get(request_id)
+        if up is None and len(self.pool.upstreams) > 1:
+            r = await self._probe(path, request_id)
+        else:
+            _, r = await self._request("GET", path, upstream=up or self.pool.upstreams[0])
+        r.raise_for_status()
+        return orjson.loads(r.content)
+
+    async def _probe(self, path: str, request_id: str) -> httpx.Response:
+        """Unknown owner (job from before upstream pinning, or upstreams reconfigured): ask every upstream.
+
+        Return the response of the first that knows the job (pinned from now on), otherwise
+        the most telling failure: a real error beats "not mine" (401/403/404).
+        """
+        best: Optional[httpx.Response] = None
+        for candidate in self.pool.upstreams:
+            try:
+                _, r = await self._request("GET", path, upstream=candidate)
+            except httpx.TransportError:
+                continue
+            if r.status_code < 400:
+                self._pin(candidate, {"request_id": request_id})
+                return r
+            if best is None or (best.status_code in self._NOT_OWNER_STATUSES and r.status_code not in self._NOT_OWNER_STATUSES):
+                best = r
+        if best is None:
+            raise httpx.ConnectError(f"ApiFree: no upstream reachable for job {request_id}")
+        return best
+
     async def chat(self, model: str, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
-        url = f"{self.base_url}/v1/chat/completions"
+        cache = self.semantic_cache
+        # only stateless one-shot prompts: with history the answer depends on more than the prompt
+        prompt = messages[0]["content"] if len(messages) == 1 and messages[0].get("role") == "user" else None
+        if cache is not None and prompt and cache.accepts(model):
+            cached = cache.lookup(model, prompt)
+            if cached is not None:
+                return cached
+        else:
+            cache = None
+
         payload: Dict[str, Any] = {"model": model, "messages": messages, "temperature": temperature}
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.post(url, headers=self._headers(), json=payload)
-            r.raise_for_status()
-            data = r.json()
-            return data["choices"][0]["message"]["content"]
+        _, r = await self._request("POST", "/v1/chat/completions", payload, idempotent=True)
+        r.raise_for_status()
+        data = orjson.loads(r.content)
+        answer = data["choices"][0]["message"]["content"]
+
+        if cache is not None:
+            cache.put(model, prompt, answer)
+            await cache.maybe_persist()
+        return answer
 
     async def image_submit(self, payload: Dict[str, Any]) -> Dict[str, Any]:
         """Submit an image job.
@@ -41,33 +361,17 @@ class ApiFreeClient:
         - {model, prompt, negative_prompt, width, height, num_images}
         - {prompt, image, image_url, aspect_ratio, resolution, ...}
         """
-        url = f"{self.base_url}/v1/image/submit"
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.post(url, headers=self._headers(), json=payload)
-            r.raise_for_status()
-            return r.json()
-
-    async def image_result(self, request_id: str) -> Dict[str, Any]:
-        url = f"{self.base_url}/v1/image/{request_id}/result"
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.get(url, headers=self._headers())
-            r.raise_for_status()
-            return r.json()
+        return await self._submit("/v1/image/submit", payload)
+
+    async def image_result(self, request_id: str, upstream: Optional[str] = None) -> Dict[str, Any]:
+        return await self._result(f"/v1/image/{request_id}/result", request_id, upstream)
 
     async def video_submit(self, payload: Dict[str, Any]) -> Dict[str, Any]:
         """Submit a video job (payload passed through as-is)."""
-        url = f"{self.base_url}/v1/video/submit"
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.post(url, headers=self._headers(), json=payload)
-            r.raise_for_status()
-            return r.json()
+        return await self._submit("/v1/video/submit", payload)
 
-    async def video_result(self, request_id: str) -> Dict[str, Any]:
-        url = f"{self.base_url}/v1/video/{request_id}/result"
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.get(url, headers=self._headers())
-            r.raise_for_status()
-            return r.json()
+    async def video_result(self, request_id: str, upstream: Optional[str] = None) -> Dict[str, Any]:
+        return await self._result(f"/v1/video/{request_id}/result", request_id, upstream)
 
 
     async def song_submit(self, payload: Dict[str, Any]) -> Dict[str, Any]:
@@ -77,23 +381,20 @@ class ApiFreeClient:
         - POST /v1/song/submit (async job -> request_id)
         - POST /v1/music/generations (may return url immediately)
         """
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            # 1) async submit
-            url1 = f"{self.base_url}/v1/song/submit"
-            r = await client.post(url1, headers=self._headers(), json=payload)
-            if r.status_code < 400:
-                return r.json()
+        # 1) async submit
+        up, r = await self._request("POST", "/v1/song/submit", payload, idempotent=False)
+        if r.status_code < 400:
+            data = orjson.loads(r.content)
+            self._pin(up, data)
+            return data
 
-            # 2) openai-style generations
-            url2 = f"{self.base_url}/v1/music/generations"
-            r2 = await client.post(url2, headers=self._headers(), json=payload)
-            r2.raise_for_status()
-            return r2.json()
+        # 2) openai-style generations, same upstream
+        _, r2 = await self._request("POST", "/v1/music/generations", payload, upstream=up)
+        r2.raise_for_status()
+        data = orjson.loads(r2.content)
+        self._pin(up, data)
+        return data
 
-    async def song_result(self, request_id: str) -> Dict[str, Any]:
+    async def song_result(self, request_id: str, upstream: Optional[str] = None) -> Dict[str, Any]:
         """Fetch song result for async jobs."""
-        url = f"{self.base_url}/v1/song/{request_id}/result"
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.get(url, headers=self._headers())
-            r.raise_for_status()
-            return r.json()
+        return await self._result(f"/v1/song/{request_id}/result", request_id, upstream)
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import mimetypes
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+try:  # optional: without it only gzip variants are served
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# not worth compressing / already compressed
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+@dataclass
+class Asset:
+    body: bytes
+    media_type: str
+    etag: str
+    cache_control: str
+    variants: Dict[str, bytes] = field(default_factory=dict)  # encoding -> body
+
+
+def _compress(body: bytes, media_type: str) -> Dict[str, bytes]:
+    if len(body) < 256 or not media_type.startswith(_COMPRESSIBLE):
+        return {}
+    out: Dict[str, bytes] = {}
+    if brotli is not None:
+        br = brotli.compress(body, quality=11)
+        if len(br) < len(body):
+            out["br"] = br
+    gz = gzip.compress(body, compresslevel=9, mtime=0)
+    if len(gz) < len(body):
+        out["gzip"] = gz
+    return out
+
+
+def _accepts(accept_encoding: str, encoding: str) -> bool:
+    for part in accept_encoding.split(","):
+        name, *params = part.split(";")
+        if name.strip().lower() != encoding:
+            continue
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                # q=0, q=0.0, q=0.000 all mean "not acceptable"
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+class AssetPipeline:
+    """Mini App assets built once at startup.
+
+    Every file except index.html gets a content-hashed alias (app.<hash>.js) served
+    with an immutable Cache-Control; index.html is rewritten to reference the
+    hashed names and is revalidated via ETag. gzip/brotli variants are precomputed
+    and picked by Accept-Encoding.
+    """
+
+    def __init__(self, directory: str, url_prefix: str = "/webapp", index: str = "index.html"):
+        self.directory = directory
+        self.url_prefix = url_prefix.rstrip("/")
+        self.index = index
+        self.assets: Dict[str, Asset] = {}
+
+    def build(self):
+        assets: Dict[str, Asset] = {}
+        renames: Dict[str, str] = {}
+        index_body: Optional[bytes] = None
+
+        for root, _dirs, files in os.walk(self.directory):
+            for fname in sorted(files):
+                full = os.path.join(root, fname)
+                rel = os.path.relpath(full, self.directory).replace(os.sep, "/")
+                with open(full, "rb") as f:
+                    body = f.read()
+                if rel == self.index:
+                    index_body = body
+                    continue
+                media_type = mimetypes.guess_type(fname)[0] or "application/octet-stream"
+                digest = hashlib.sha256(body).hexdigest()
+                stem, ext = os.path.splitext(rel)
+                hashed = f"{stem}.{digest[:10]}{ext}"
+                variants = _compress(body, media_type)
+                # original name stays reachable (old cached index.html), but must revalidate
+                assets[rel] = Asset(body, media_type, f'"{digest[:16]}"', REVALIDATE, variants)
+                assets[hashed] = Asset(body, media_type, f'"{digest[:16]}"', IMMUTABLE, variants)
+                renames[rel] = hashed
+
+        if index_body is not None:
+            html = index_body.decode("utf-8")
+            # longest first so "a.js" does not clobber "data.js"
+            for rel in sorted(renames, key=len, reverse=True):
+                html = html.replace(f"{self.url_prefix}/{rel}", f"{self.url_prefix}/{renames[rel]}")
+            body = html.encode("utf-8")
+            media_type = "text/html; charset=utf-8"
+            digest = hashlib.sha256(body).hexdigest()
+            assets[self.index] = Asset(body, media_type, f'"{digest[:16]}"', REVALIDATE, _compress(body, "text/html"))
+
+        self.assets = assets
+        return self
+
+    def lookup(self, path: str) -> Optional[Asset]:
+        return self.assets.get(path or self.index)
+
+    @staticmethod
+    def negotiate(asset: Asset, accept_encoding: str):
+        """-> (encoding or None, body)"""
+        for encoding in ("br", "gzip"):
+            if encoding in asset.variants and _accepts(accept_encoding, encoding):
+                return encoding, asset.variants[encoding]
+        return None, asset.body
+
+    @staticmethod
+    def etag_for(asset: Asset, encoding: Optional[str]) -> str:
+        # representation-specific ETag: compressed bodies differ byte-wise
+        if encoding is None:
+            return asset.etag
+        return asset.etag[:-1] + f'-{encoding}"'
+
+    @staticmethod
+    def not_modified(if_none_match: str, etag: str) -> bool:
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return etag in tags
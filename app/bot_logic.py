@@ -1,16 +1,24 @@
 from __future__ import annotations
 
+import html
 import re
 from typing import Any, Dict, Optional, List
+
+import orjson
+
 from .storage import Storage
-from .telegram_api import TelegramAPI
+from .telegram_api import TelegramAPI, TelegramError
 from .apifree_client import ApiFreeClient
+from .broadcast import get_broadcaster
 from .config import settings
+from .updates import TgUser, Update, parse_update
 
 START_RE = re.compile(r"^/start(?:\s+(.+))?$")
+BROADCAST_RE = re.compile(r"^/broadcast(_stop)?(?:@\w+)?(?:\s+(.+))?$", re.S)
 
-def _main_menu(webapp_url: str) -> Dict[str, Any]:
-    return {
+def _main_menu(webapp_url: str) -> str:
+    """Main keyboard, serialised once (Telegram accepts reply_markup as a JSON string)."""
+    return orjson.dumps({
         "inline_keyboard": [
             [
                 {"text": "💬 ChatGPT", "callback_data": "mode:chat"},
@@ -32,23 +40,29 @@ def _main_menu(webapp_url: str) -> Dict[str, Any]:
                 {"text": "🛟 Помощь", "callback_data": "help"},
             ],
         ]
-    }
+    }).decode()
 
-def _share_keyboard(ref_link: str) -> Dict[str, Any]:
-    return {
-        "inline_keyboard": [
-            [{"text": "🔗 Поделиться ссылкой", "switch_inline_query": ref_link}],
-            [{"text": "⬅️ Назад", "callback_data": "back:menu"}],
-        ]
-    }
+# pre-serialised around a placeholder; only the (JSON-escaped) link is spliced in per call
+_SHARE_KB_PREFIX, _SHARE_KB_SUFFIX = orjson.dumps({
+    "inline_keyboard": [
+        [{"text": "🔗 Поделиться ссылкой", "switch_inline_query": "\x00"}],
+        [{"text": "⬅️ Назад", "callback_data": "back:menu"}],
+    ]
+}).decode().split('"\\u0000"')
+
+def _share_keyboard(ref_link: str) -> str:
+    return _SHARE_KB_PREFIX + orjson.dumps(ref_link).decode() + _SHARE_KB_SUFFIX
 
 def _webapp_url() -> str:
     return f"{settings.PUBLIC_BASE_URL.rstrip('/')}/webapp/"
 
-async def ensure_user(storage: Storage, tg_user: Dict[str, Any], start_payload: Optional[str]):
-    tg_id = tg_user["id"]
-    username = tg_user.get("username")
-    first_name = tg_user.get("first_name")
+MAIN_MENU = _main_menu(_webapp_url())
+ADMIN_IDS = frozenset(settings.admin_ids())
+
+async def ensure_user(storage: Storage, tg_user: TgUser, start_payload: Optional[str]):
+    tg_id = tg_user.id
+    username = tg_user.username
+    first_name = tg_user.first_name
 
     u = await storage.get_user(tg_id)
     if u:
@@ -60,46 +74,81 @@ async def ensure_user(storage: Storage, tg_user: Dict[str, Any], start_payload:
             referred_by = int(start_payload.replace("ref_", ""))
         except Exception:
             referred_by = None
-
-    # create user
-    await storage.upsert_user(
+    if referred_by == tg_id:
+        referred_by = None
+
+    # create user + referral bonuses in one transaction (bonuses only on first signup)
+    credits_free = settings.FREE_CREDITS_ON_SIGNUP
+    if referred_by:
+        credits_free += settings.REF_BONUS_NEW_USER
+    await storage.register_user(
         tg_id=tg_id,
         username=username,
         first_name=first_name,
-        credits_free=settings.FREE_CREDITS_ON_SIGNUP,
+        credits_free=credits_free,
         referred_by=referred_by,
+        referrer_bonus=settings.REF_BONUS_REFERRER,
     )
 
-    # apply referral bonuses only on first signup
-    if referred_by and referred_by != tg_id:
-        # give referrer +1, new user +1 (extra)
-        await storage.add_credits(referred_by, free_delta=settings.REF_BONUS_REFERRER)
-        await storage.add_credits(tg_id, free_delta=settings.REF_BONUS_NEW_USER)
+async def handle_admin_broadcast(storage: Storage, tg: TelegramAPI, chat_id: int, admin_id: int, m: re.Match):
+    broadcaster = await get_broadcaster(storage, tg, rate=settings.BROADCAST_RATE, chunk_size=settings.BROADCAST_CHUNK)
+    if m.group(1):
+        n = await broadcaster.cancel_all()
+        await tg.send_message(chat_id, f"⛔ Остановлено рассылок: {n}")
+        return
+    text = (m.group(2) or "").strip()
+    if not text:
+        await tg.send_message(chat_id, "Использование: <code>/broadcast текст</code>\nОстановить: /broadcast_stop")
+        return
+    # preview first: text Telegram can't parse (a stray "<" in HTML) would fail for every recipient
+    try:
+        await tg.send_message(chat_id, text)
+    except TelegramError as e:
+        if e.error_code != 400:
+            raise
+        await tg.send_message(chat_id, f"⚠️ Telegram не принял текст: {html.escape(e.description)}\nРассылка не запущена. Для символов &lt; и &gt; используйте &amp;lt; и &amp;gt;.")
+        return
+    b = await broadcaster.start(admin_id, text)
+    await tg.send_message(chat_id, f"📣 Рассылка #{b.id} запущена. Прогресс будет обновляться здесь.")
 
 async def handle_update(storage: Storage, tg: TelegramAPI, apifree: ApiFreeClient, update: Dict[str, Any]):
+    # resumes broadcasts interrupted by a restart (no-op after the first update)
+    await get_broadcaster(storage, tg, rate=settings.BROADCAST_RATE, chunk_size=settings.BROADCAST_CHUNK)
+
+    upd: Update = parse_update(update)
+    from_user = upd.from_user
+    if from_user is None or upd.chat_id is None:
+        return
+    chat_id = upd.chat_id
+
     # message
-    if "message" in update:
-        msg = update["message"]
-        chat_id = msg["chat"]["id"]
-        text = msg.get("text", "")
+    if upd.is_message:
+        text = upd.text
+
+        m = BROADCAST_RE.match(text)
+        if m and from_user.id in ADMIN_IDS:
+            await handle_admin_broadcast(storage, tg, chat_id, from_user.id, m)
+            return
 
-        m = START_RE.match(text or "")
+        m = START_RE.match(text)
         if m:
             payload = m.group(1)
-            await ensure_user(storage, msg["from"], payload)
+            await ensure_user(storage, from_user, payload)
+            # user is back: include in broadcasts again
+            await storage.unblock_user(from_user.id)
             await tg.send_message(
                 chat_id,
                 "<b>Привет! Я Creator_Kristina.ai 🤍</b>\n\n"                "Я умею: <b>ChatGPT</b>, <b>генерация фото</b>, <b>генерация видео</b> — через ApiFree.\n\n"                "Выбирай режим ниже 👇",
-                reply_markup=_main_menu(_webapp_url()),
+                reply_markup=MAIN_MENU,
             )
             return
 
         # plain text -> chat (quick mode)
         if text:
-            await ensure_user(storage, msg["from"], None)
+            await ensure_user(storage, from_user, None)
             ok = await storage.consume_credit(chat_id)
             if not ok:
-                await tg.send_message(chat_id, "⚠️ У тебя закончились кредиты. Нажми ⭐ PRO или пригласи друга 🎁", reply_markup=_main_menu(_webapp_url()))
+                await tg.send_message(chat_id, "⚠️ У тебя закончились кредиты. Нажми ⭐ PRO или пригласи друга 🎁", reply_markup=MAIN_MENU)
                 return
 
             await tg.send_message(chat_id, "⌛ Думаю...")
@@ -107,71 +156,69 @@ async def handle_update(storage: Storage, tg: TelegramAPI, apifree: ApiFreeClien
                 model=settings.APIFREE_CHAT_MODEL,
                 messages=[{"role": "user", "content": text}],
             )
-            await tg.send_message(chat_id, answer, reply_markup=_main_menu(_webapp_url()))
+            await tg.send_message(chat_id, answer, reply_markup=MAIN_MENU)
             return
 
     # callback query
-    if "callback_query" in update:
-        cq = update["callback_query"]
-        data = cq.get("data", "")
-        chat_id = cq["message"]["chat"]["id"]
-        from_user = cq["from"]
+    if upd.is_callback:
+        cq_id = upd.callback_id
+        data = upd.callback_data
         await ensure_user(storage, from_user, None)
 
         if data == "back:menu":
-            await tg.answer_callback_query(cq["id"])
-            await tg.send_message(chat_id, "Меню 👇", reply_markup=_main_menu(_webapp_url()))
+            await tg.answer_callback_query(cq_id)
+            await tg.send_message(chat_id, "Меню 👇", reply_markup=MAIN_MENU)
             return
 
         if data.startswith("ref:"):
-            ref_link = f"https://t.me/{cq['message']['chat'].get('username','')}?start=ref_{from_user['id']}"
             # if bot username unknown in message, use placeholder; miniapp uses proper link.
-            ref_link = f"https://t.me/{update.get('bot_username','your_bot')}?start=ref_{from_user['id']}"
-            await tg.answer_callback_query(cq["id"])
+            ref_link = f"https://t.me/{upd.bot_username or 'your_bot'}?start=ref_{from_user.id}"
+            invited = await storage.referral_count(from_user.id)
+            await tg.answer_callback_query(cq_id)
             await tg.send_message(
                 chat_id,
-                "🎁 <b>Приглашай друзей</b> и получай бесплатные генерации!\n\n"                f"Твоя ссылка:\n<code>{ref_link}</code>\n\n"                "Друг запускает бота по ссылке → вам обоим начисляются кредиты.",
+                "🎁 <b>Приглашай друзей</b> и получай бесплатные генерации!\n\n"                f"Твоя ссылка:\n<code>{ref_link}</code>\n\n"                "Друг запускает бота по ссылке → вам обоим начисляются кредиты.\n"                f"Уже приглашено: <b>{invited}</b>",
                 reply_markup=_share_keyboard(ref_link),
             )
             return
 
         if data == "me:balance":
-            u = await storage.get_user(from_user["id"])
-            await tg.answer_callback_query(cq["id"])
+            u = await storage.get_user(from_user.id)
+            await tg.answer_callback_query(cq_id)
             await tg.send_message(
                 chat_id,
                 f"💳 <b>Баланс</b>\n"                f"• Free: <b>{u.credits_free}</b>\n"                f"• PRO: <b>{u.credits_pro}</b>",
-                reply_markup=_main_menu(_webapp_url()),
+                reply_markup=MAIN_MENU,
             )
             return
 
         if data == "help":
-            await tg.answer_callback_query(cq["id"])
+            await tg.answer_callback_query(cq_id)
             await tg.send_message(
                 chat_id,
                 "🛟 <b>Как пользоваться</b>\n\n"                "1) Напиши текст — получишь ответ ChatGPT\n"                "2) Для фото/видео удобнее через Mini‑App (⚡)\n"                "3) Хочешь больше бесплатных генераций — нажми 🎁 и пригласи друга\n\n"                "Если что-то не работает — проверь токены и домен (Render env vars).",
 
-                reply_markup=_main_menu(_webapp_url()),
+                reply_markup=MAIN_MENU,
             )
             return
 
         if data == "pro:buy":
-            await tg.answer_callback_query(cq["id"])
+            await tg.answer_callback_query(cq_id)
             if settings.PRICE_PRO_XTR <= 0:
-                await tg.send_message(chat_id, "⭐ PRO сейчас выключен. Напиши мне — включу оплату.", reply_markup=_main_menu(_webapp_url()))
+                await tg.send_message(chat_id, "⭐ PRO сейчас выключен. Напиши мне — включу оплату.", reply_markup=MAIN_MENU)
                 return
             prices = [{"label": "PRO пакет", "amount": settings.PRICE_PRO_XTR}]
             await tg.send_invoice_stars(
                 chat_id=chat_id,
                 title="Creator_Kristina.ai PRO",
                 description="Больше генераций + приоритет.",
-                payload=f"pro:{from_user['id']}",
+                payload=f"pro:{from_user.id}",
                 prices=prices,
             )
             return
 
         if data.startswith("mode:"):
-            await tg.answer_callback_query(cq["id"], text="Открой Mini‑App для этого режима ⚡")
+            await tg.answer_callback_query(cq_id, text="Открой Mini‑App для этого режима ⚡")
             return
 
-        await tg.answer_callback_query(cq["id"])
+        await tg.answer_callback_query(cq_id)
@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from .storage import Broadcast, Storage
+from .telegram_api import TelegramAPI, TelegramError
+
+log = logging.getLogger(__name__)
+
+# Telegram answers 403 ("bot was blocked by the user", "user is deactivated")
+# or 400 ("chat not found") for recipients that can never be reached again.
+_UNREACHABLE_HINTS = ("blocked", "deactivated", "chat not found", "user not found", "kicked")
+
+
+def _fmt_eta(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds}s"
+
+
+class AdaptiveRateLimiter:
+    """Spaces sends to `rate` msg/s.
+
+    On 429 everyone pauses for `retry_after` and the rate is cut (x0.7);
+    every success raises it back additively up to `max_rate` (AIMD). A sender
+    that went to sleep before the 429 re-checks the pause when it wakes up.
+    """
+
+    def __init__(self, max_rate: float, min_rate: float = 1.0):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                wait = self._next_at - now
+                if wait <= 0:
+                    self._next_at = now + 1.0 / self.rate
+                    return
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + 0.05)
+
+    def on_flood(self, retry_after: float):
+        self.rate = max(self.min_rate, self.rate * 0.7)
+        self._next_at = max(self._next_at, time.monotonic() + retry_after)
+
+
+class Broadcaster:
+    """Admin broadcast engine.
+
+    Recipients are streamed from `users` in keyset-paginated chunks (tg_id > cursor),
+    sent under an adaptive rate limit, and the cursor + counters are checkpointed in
+    `broadcasts` after every chunk, so a restart resumes from the last finished chunk
+    (at most one chunk is re-sent). The cursor never moves past a recipient whose
+    send did not complete: 429s are retried until they go through. Blocked users go
+    to `blocked_users` and are skipped by later broadcasts.
+
+    Several workers may share the database: a broadcast runs only in the worker
+    holding its lease (`owner`, `lease_until`), renewed every `lease_s / 3`. An
+    expired lease (dead worker) is taken over by `resume_pending`. /broadcast_stop
+    stores status "cancelled", which the owner sees at its next renewal.
+    """
+
+    def __init__(self, storage: Storage, tg: TelegramAPI, rate: float = 25.0, chunk_size: int = 500, max_in_flight: int = 50,
+                 report_every_s: float = 5.0, lease_s: float = 60.0):
+        self.storage = storage
+        self.tg = tg
+        self.limiter = AdaptiveRateLimiter(rate)
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.report_every_s = report_every_s
+        self.lease_s = lease_s
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._stops: Dict[int, asyncio.Event] = {}
+        self._resumed_at: Optional[float] = None
+
+    async def start(self, admin_id: int, text: str) -> Broadcast:
+        b = await self.storage.create_broadcast(admin_id, text, self.owner, self.lease_s)
+        self._spawn(b)
+        return b
+
+    async def resume_pending(self):
+        """Run broadcasts interrupted by a restart or left behind by a dead worker."""
+        self._resumed_at = time.monotonic()
+        for b in await self.storage.running_broadcasts():
+            if b.id in self._tasks:
+                continue
+            claimed = await self.storage.claim_broadcast(b.id, self.owner, self.lease_s)
+            if claimed is not None:
+                log.info("resuming broadcast #%s after tg_id=%s", b.id, b.last_tg_id)
+                self._spawn(claimed)
+
+    async def maybe_resume(self):
+        if self._resumed_at is None or time.monotonic() - self._resumed_at >= self.lease_s:
+            await self.resume_pending()
+
+    async def cancel_all(self) -> int:
+        """Stop every running broadcast, in this worker and in the others."""
+        n = await self.storage.cancel_broadcasts()
+        for stop in self._stops.values():
+            stop.set()
+        return n
+
+    def _spawn(self, b: Broadcast):
+        self._stops[b.id] = asyncio.Event()
+        task = asyncio.create_task(self._run(b))
+        self._tasks[b.id] = task
+
+        def _done(_t, bid=b.id):
+            self._tasks.pop(bid, None)
+            self._stops.pop(bid, None)
+
+        task.add_done_callback(_done)
+
+    async def _keep_lease(self, b: Broadcast, stop: asyncio.Event):
+        while not stop.is_set():
+            await asyncio.sleep(self.lease_s / 3)
+            try:
+                claimed = await self.storage.claim_broadcast(b.id, self.owner, self.lease_s)
+            except Exception as e:
+                log.warning("broadcast #%s: lease renewal failed: %s", b.id, e)
+                continue
+            if claimed is None:
+                # cancelled by /broadcast_stop (any worker) or taken over after an expired lease
+                stop.set()
+
+    async def _run(self, b: Broadcast):
+        stop = self._stops[b.id]
+        started = time.monotonic()
+        done_at_start = b.sent + b.failed + b.blocked
+        remaining = await self.storage.count_recipients_after(b.last_tg_id)
+        total = done_at_start + remaining
+        last_report = 0.0
+        sem = asyncio.Semaphore(self.max_in_flight)
+        keeper = asyncio.create_task(self._keep_lease(b, stop))
+
+        try:
+            while not stop.is_set():
+                chunk = await self.storage.recipients_after(b.last_tg_id, self.chunk_size)
+                if not chunk:
+                    break
+                results = await asyncio.gather(*(self._send_one(sem, stop, tg_id, b.text) for tg_id in chunk))
+
+                blocked: List[int] = []
+                for tg_id, result in zip(chunk, results):
+                    if result is None:
+                        # stopped before this send: the checkpoint stays in front of it
+                        break
+                    if result == "sent":
+                        b.sent += 1
+                    elif result == "blocked":
+                        b.blocked += 1
+                        blocked.append(tg_id)
+                    else:
+                        b.failed += 1
+                    b.last_tg_id = tg_id
+                if blocked:
+                    await self.storage.mark_blocked(blocked)
+                status = await self.storage.save_broadcast(b, self.lease_s)
+                if status != "running":
+                    stop.set()
+
+                now = time.monotonic()
+                if now - last_report >= self.report_every_s:
+                    last_report = now
+                    await self._report(b, total, done_at_start, started)
+
+            if not stop.is_set():
+                b.status = "done"
+            status = await self.storage.save_broadcast(b)
+            if status is None:
+                log.warning("broadcast #%s: lease lost to another worker, stopping here", b.id)
+                return
+            b.status = status
+            await self._report(b, total, done_at_start, started)
+        except Exception:
+            # status stays "running": the checkpoint is resumed once the lease expires
+            log.exception("broadcast #%s crashed at tg_id=%s", b.id, b.last_tg_id)
+        finally:
+            keeper.cancel()
+
+    async def _send_one(self, sem: asyncio.Semaphore, stop: asyncio.Event, tg_id: int, text: str) -> Optional[str]:
+        """"sent" / "blocked" / "failed", or None if the broadcast was stopped before the send."""
+        async with sem:
+            while not stop.is_set():
+                await self.limiter.acquire()
+                if stop.is_set():
+                    break
+                try:
+                    await self.tg.send_message(tg_id, text)
+                    self.limiter.on_success()
+                    return "sent"
+                except TelegramError as e:
+                    if e.error_code == 429:
+                        # flood control is not a delivery failure: wait and retry
+                        self.limiter.on_flood(float(e.retry_after or 1))
+                        continue
+                    desc = e.description.lower()
+                    if e.error_code in (400, 403) and any(h in desc for h in _UNREACHABLE_HINTS):
+                        return "blocked"
+                    return "failed"
+                except Exception:
+                    return "failed"
+            return None
+
+    async def _report(self, b: Broadcast, total: int, done_at_start: int, started: float):
+        done = b.sent + b.failed + b.blocked
+        elapsed = max(time.monotonic() - started, 1e-6)
+        speed = (done - done_at_start) / elapsed
+        eta = (total - done) / speed if speed > 0 else 0
+        title = {"running": "📣 Рассылка идёт", "done": "✅ Рассылка завершена", "cancelled": "⛔ Рассылка остановлена"}[b.status]
+        text = (
+            f"{title} #{b.id}\n"
+            f"• Обработано: <b>{done}</b> / {total}\n"
+            f"• Доставлено: {b.sent} • заблокировали: {b.blocked} • ошибки: {b.failed}\n"
+            f"• Скорость: {speed:.1f} msg/s"
+        )
+        if b.status == "running":
+            text += f" • ETA: {_fmt_eta(eta)}"
+        try:
+            if b.progress_message_id:
+                await self.tg.edit_message_text(b.admin_id, b.progress_message_id, text)
+            else:
+                data = await self.tg.send_message(b.admin_id, text)
+                b.progress_message_id = data["result"]["message_id"]
+                await self.storage.save_broadcast(b)
+        except Exception as e:
+            log.warning("broadcast #%s: progress report failed: %s", b.id, e)
+
+
+_broadcaster: Optional[Broadcaster] = None
+
+
+async def get_broadcaster(storage: Storage, tg: TelegramAPI, rate: float = 25.0, chunk_size: int = 500) -> Broadcaster:
+    """Process-wide broadcaster. Resumes interrupted broadcasts on the first call, then at most once per lease."""
+    global _broadcaster
+    if _broadcaster is None:
+        _broadcaster = Broadcaster(storage, tg, rate=rate, chunk_size=chunk_size)
+    await _broadcaster.maybe_resume()
+    return _broadcaster
@@ -1,97 +1,141 @@
 import os
-import json
+import orjson
 import asyncio
-import aiosqlite
-from typing import Dict, Any, Optional
+import logging
+from typing import Dict, Any, Optional, Set
 
 from fastapi import FastAPI, Request, Body
-from fastapi.responses import JSONResponse, PlainTextResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse, PlainTextResponse, FileResponse, Response, RedirectResponse
+
+from .apifree_client import ApiFreeClient, extract_job_state, extract_request_id, parse_upstreams
+from .assets import AssetPipeline
+from .bot_logic import handle_update
+from .broadcast import get_broadcaster
+from .config import settings
+from .polling import UpdatePoller
+from .semantic_cache import create_semantic_cache
+from .storage import Storage, User, create_storage
+from .telegram_api import TelegramAPI
+from .webapp_auth import verify_init_data
 
 # =========================
 # CONFIG
 # =========================
 
-DATABASE = "bot.db"
-WEBAPP_DIR = "app/webapp"
-BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+WEBAPP_DIR = os.getenv("WEBAPP_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "webapp"))
+BOT_TOKEN = settings.BOT_TOKEN
+# "webhook" (default, needs a public URL) or "polling" (getUpdates, works locally / behind NAT)
+UPDATES_MODE = settings.UPDATES_MODE.strip().lower()
+POLLING_CONCURRENCY = settings.POLLING_CONCURRENCY
+
+log = logging.getLogger(__name__)
 
 # =========================
 # APP
 # =========================
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # =========================
 # STATIC WEBAPP
 # =========================
 
-if os.path.isdir(WEBAPP_DIR):
-    app.mount("/webapp", StaticFiles(directory=WEBAPP_DIR), name="webapp")
+# built once at startup: hashed names + precompressed gzip/br variants
+webapp_assets = AssetPipeline(WEBAPP_DIR, url_prefix="/webapp")
+
+@app.get("/webapp")
+async def webapp_redirect():
+    return RedirectResponse("/webapp/")
+
+@app.api_route("/webapp/{path:path}", methods=["GET", "HEAD"])
+async def webapp_static(path: str, req: Request):
+    asset = webapp_assets.lookup(path)
+    if asset is None:
+        return PlainTextResponse("Not Found", status_code=404)
+
+    encoding, body = webapp_assets.negotiate(asset, req.headers.get("accept-encoding", ""))
+    etag = webapp_assets.etag_for(asset, encoding)
+    headers = {"Cache-Control": asset.cache_control, "ETag": etag, "Vary": "Accept-Encoding"}
+    if webapp_assets.not_modified(req.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    if req.method == "HEAD":
+        headers["Content-Length"] = str(len(body))
+        body = b""
+    return Response(body, media_type=asset.media_type, headers=headers)
 
 # =========================
-# DATABASE INIT
+# STORAGE (SQLite at DB_PATH, Postgres when DATABASE_URL is set)
 # =========================
 
-async def init_db():
-    async with aiosqlite.connect(DATABASE) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            tg_id INTEGER PRIMARY KEY,
-            free_credits INTEGER DEFAULT 50,
-            pro_credits INTEGER DEFAULT 0
-        )
-        """)
-        await db.commit()
+storage: Storage = create_storage(settings.DATABASE_URL, settings.DB_PATH, settings.PG_POOL_MIN, settings.PG_POOL_MAX)
+tg = TelegramAPI(BOT_TOKEN)
+apifree = ApiFreeClient(
+    settings.APIFREE_BASE_URL,
+    settings.APIFREE_API_KEY,
+    semantic_cache=create_semantic_cache(settings),  # None unless SEMANTIC_CACHE_ENABLED
+    upstreams=parse_upstreams(settings.APIFREE_UPSTREAMS) or None,  # replaces base url/key when set
+)
+
+_poller: Optional[UpdatePoller] = None
+_poller_task: Optional[asyncio.Task] = None
+# webhook updates handled after the ack (strong refs: the loop only keeps weak ones)
+_update_tasks: Set[asyncio.Task] = set()
 
 @app.on_event("startup")
 async def startup():
-    await init_db()
+    global _poller, _poller_task
+    await storage.init()
+    if os.path.isdir(WEBAPP_DIR):
+        webapp_assets.build()
+    # picks up broadcasts interrupted by a restart without waiting for the first update
+    await get_broadcaster(storage, tg, rate=settings.BROADCAST_RATE, chunk_size=settings.BROADCAST_CHUNK)
+
+    if UPDATES_MODE == "polling" and BOT_TOKEN:
+        _poller = UpdatePoller(
+            tg,
+            handler=process_update,
+            load_offset=load_updates_offset,
+            save_offset=save_updates_offset,
+            max_concurrency=POLLING_CONCURRENCY,
+        )
+        _poller_task = asyncio.create_task(_poller.run())
+
+@app.on_event("shutdown")
+async def shutdown():
+    if _poller:
+        _poller.stop()
+    if _poller_task:
+        _poller_task.cancel()
+    if _update_tasks:
+        await asyncio.wait(_update_tasks, timeout=10)
+    await tg.aclose()
+    await apifree.aclose()
+    if apifree.semantic_cache is not None:
+        apifree.semantic_cache.save()
+    await storage.close()
 
 # =========================
 # DB HELPERS
 # =========================
 
-async def db_fetchone(db, sql, params=()):
-    cur = await db.execute(sql, params)
-    row = await cur.fetchone()
-    return row
+def _me(user: User) -> Dict[str, Any]:
+    return {"tg_id": user.tg_id, "free": user.credits_free, "pro": user.credits_pro}
 
-async def get_or_create_user(tg_id: int):
-    async with aiosqlite.connect(DATABASE) as db:
-        row = await db_fetchone(db,
-            "SELECT tg_id, free_credits, pro_credits FROM users WHERE tg_id=?",
-            (tg_id,)
-        )
-        if row:
-            return {"tg_id": row[0], "free": row[1], "pro": row[2]}
+async def get_or_create_user(tg_id: int) -> User:
+    user = await storage.get_user(tg_id)
+    if user is None:
+        await storage.register_user(tg_id, None, None, settings.FREE_CREDITS_ON_SIGNUP, None, 0)
+        user = await storage.get_user(tg_id)
+    return user
 
-        await db.execute(
-            "INSERT INTO users (tg_id, free_credits, pro_credits) VALUES (?, 50, 0)",
-            (tg_id,)
-        )
-        await db.commit()
-        return {"tg_id": tg_id, "free": 50, "pro": 0}
-
-async def consume_credit(tg_id: int):
-    async with aiosqlite.connect(DATABASE) as db:
-        row = await db_fetchone(db,
-            "SELECT free_credits FROM users WHERE tg_id=?",
-            (tg_id,)
-        )
-        if not row:
-            return False
+async def load_updates_offset() -> Optional[int]:
+    value = await storage.get_state("updates_offset")
+    return int(value) if value else None
 
-        free = row[0]
-        if free <= 0:
-            return False
-
-        await db.execute(
-            "UPDATE users SET free_credits = free_credits - 1 WHERE tg_id=?",
-            (tg_id,)
-        )
-        await db.commit()
-        return True
+async def save_updates_offset(offset: int):
+    await storage.set_state("updates_offset", str(offset))
 
 # =========================
 # ROOT
@@ -109,14 +153,18 @@ async def favicon():
 # API MODELS
 # =========================
 
+MODELS_CATALOG = {
+    "chat": ["gpt", "grok"],
+    "image": ["nano-banana"],
+    "video": ["kling", "veo"],
+    "music": ["mureka"]
+}
+# serialised once, reused by /api/models and /api/bootstrap
+MODELS_JSON = orjson.dumps(MODELS_CATALOG)
+
 @app.get("/api/models")
 async def api_models():
-    return JSONResponse({
-        "chat": ["gpt", "grok"],
-        "image": ["nano-banana"],
-        "video": ["kling", "veo"],
-        "music": ["mureka"]
-    })
+    return Response(MODELS_JSON, media_type="application/json")
 
 # =========================
 # API ME
@@ -125,7 +173,43 @@ async def api_models():
 @app.get("/api/me")
 async def api_me(tg_id: int):
     user = await get_or_create_user(tg_id)
-    return JSONResponse(user)
+    return ORJSONResponse(_me(user))
+
+# =========================
+# API BOOTSTRAP (Mini App start: models + profile + in-flight jobs)
+# =========================
+
+async def load_profile_and_jobs(tg_id: int, jobs_limit: int = 20):
+    """User + unfinished jobs in one query (LEFT JOIN), user is created if missing."""
+    user, jobs = await storage.profile_with_jobs(tg_id, jobs_limit)
+    if user is None:
+        return _me(await get_or_create_user(tg_id)), []
+    return _me(user), jobs
+
+def init_data_user_id(req: Request) -> Optional[int]:
+    """Telegram user id from a valid X-Telegram-Init-Data header, None if missing or forged."""
+    init_data = req.headers.get("x-telegram-init-data", "")
+    tg_user = verify_init_data(init_data, BOT_TOKEN) if init_data else None
+    return int(tg_user["id"]) if tg_user else None
+
+@app.get("/api/bootstrap")
+async def api_bootstrap(req: Request):
+    me = None
+    jobs = []
+    if req.headers.get("x-telegram-init-data"):
+        tg_id = init_data_user_id(req)
+        if tg_id is None:
+            return ORJSONResponse({"error": "bad initData"}, status_code=401)
+        me, jobs = await load_profile_and_jobs(tg_id)
+
+    # models fragment is precomputed, only the per-user part is serialised here
+    body = b"".join((
+        b'{"models":', MODELS_JSON,
+        b',"me":', orjson.dumps(me),
+        b',"jobs":', orjson.dumps(jobs),
+        b"}",
+    ))
+    return Response(body, media_type="application/json")
 
 # =========================
 # API CHAT
@@ -137,60 +221,108 @@ async def api_chat(body: Dict[str, Any] = Body(...)):
     prompt = body.get("prompt")
 
     if not tg_id or not prompt:
-        return JSONResponse({"error": "bad request"}, status_code=400)
+        return ORJSONResponse({"error": "bad request"}, status_code=400)
 
-    ok = await consume_credit(int(tg_id))
+    ok = await storage.consume_credit(int(tg_id))
     if not ok:
-        return JSONResponse({"error": "no credits"}, status_code=403)
+        return ORJSONResponse({"error": "no credits"}, status_code=403)
 
     # MOCK RESPONSE (здесь потом подключим API)
     answer = f"Ответ модели на: {prompt}"
 
-    return JSONResponse({
+    return ORJSONResponse({
         "status": "ok",
         "reply": answer
     })
 
 # =========================
-# TELEGRAM WEBHOOK
+# API JOBS (image / video / music)
 # =========================
 
-@app.post("/telegram/webhook/hook")
-async def telegram_webhook(req: Request):
+# kind -> (submit method, result method, default model)
+JOB_KINDS = {
+    "image": ("image_submit", "image_result", settings.APIFREE_IMAGE_MODEL),
+    "video": ("video_submit", "video_result", settings.APIFREE_VIDEO_MODEL),
+    "music": ("song_submit", "song_result", settings.APIFREE_SONG_MODEL),
+}
+
+@app.post("/api/{kind}/submit")
+async def api_job_submit(kind: str, req: Request, body: Dict[str, Any] = Body(...)):
+    if kind not in JOB_KINDS:
+        return ORJSONResponse({"error": "unknown kind"}, status_code=404)
+    tg_id = init_data_user_id(req)
+    if tg_id is None:
+        return ORJSONResponse({"error": "bad initData"}, status_code=401)
+    user = await storage.get_user(tg_id)
+    # charged before the (slow) submit: concurrent submits can't all pass on the same credit
+    if user is None or not await storage.consume_credit(tg_id):
+        return ORJSONResponse({"error": "no credits"}, status_code=403)
+
+    submit, _, default_model = JOB_KINDS[kind]
+    payload = {**body, "model": body.get("model") or default_model}
     try:
-        data = await req.json()
-    except:
-        return JSONResponse({"ok": True})
-
-    message = data.get("message", {})
-    chat = message.get("chat", {})
-    text = message.get("text", "")
-
-    chat_id = chat.get("id")
-
-    if not chat_id:
-        return JSONResponse({"ok": True})
-
-    if text == "/start":
-        await send_telegram(chat_id, "Бот работает 🚀")
-
-    return JSONResponse({"ok": True})
+        data = await getattr(apifree, submit)(payload)
+    except Exception:
+        # consume_credit spends PRO first
+        pro = 1 if user.credits_pro > 0 else 0
+        await storage.add_credits(tg_id, free_delta=1 - pro, pro_delta=pro)
+        raise
+
+    status, url = extract_job_state(data)
+    request_id = extract_request_id(data)
+    if request_id is None:  # answered synchronously, nothing to poll
+        return ORJSONResponse({"status": status, "url": url})
+    # the upstream that accepted the job is the only one that can return its result
+    await storage.create_job(tg_id, kind, request_id, status, upstream=apifree.upstream_for(request_id),
+                             payload_json=orjson.dumps(payload).decode())
+    return ORJSONResponse({"job_id": request_id, "status": status, "url": url})
+
+@app.get("/api/{kind}/result/{request_id}")
+async def api_job_result(kind: str, request_id: str, req: Request):
+    tg_id = init_data_user_id(req)
+    if tg_id is None:
+        return ORJSONResponse({"error": "bad initData"}, status_code=401)
+    job = await storage.get_job(tg_id, request_id)
+    if job is None or job["kind"] != kind:
+        return ORJSONResponse({"error": "job not found"}, status_code=404)
+
+    _, result, _ = JOB_KINDS[kind]
+    data = await getattr(apifree, result)(request_id, upstream=job["upstream"])
+    status, url = extract_job_state(data)
+    if status != job["status"]:
+        await storage.set_job_status(job["id"], status)
+    return ORJSONResponse({"status": status, "url": url})
 
 # =========================
-# TELEGRAM SEND
+# TELEGRAM WEBHOOK
 # =========================
 
-async def send_telegram(chat_id, text):
-    if not BOT_TOKEN:
-        return
+WEBHOOK_ACK = orjson.dumps({"ok": True})
 
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": chat_id,
-        "text": text
-    }
+@app.post("/telegram/webhook/hook")
+async def telegram_webhook(req: Request):
+    try:
+        data = orjson.loads(await req.body())
+    except orjson.JSONDecodeError:
+        return Response(WEBHOOK_ACK, media_type="application/json")
+
+    # ack right away: Telegram redelivers updates that aren't answered in time, and
+    # handling one (credits, an LLM reply) can take longer than that
+    task = asyncio.create_task(_process_update_logged(data))
+    _update_tasks.add(task)
+    task.add_done_callback(_update_tasks.discard)
+    return Response(WEBHOOK_ACK, media_type="application/json")
+
+async def _process_update_logged(data: Dict[str, Any]):
+    try:
+        await process_update(data)
+    except Exception:
+        # already acked: Telegram won't redeliver it
+        log.exception("update %s failed", data.get("update_id"))
 
-    import httpx
-    async with httpx.AsyncClient() as client:
-        await client.post(url, json=payload)
+# =========================
+# UPDATE HANDLER (webhook + polling)
+# =========================
 
+async def process_update(data: Dict[str, Any]):
+    await handle_update(storage, tg, apifree, data)
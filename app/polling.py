@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from .telegram_api import TelegramAPI
+
+log = logging.getLogger(__name__)
+
+UpdateHandler = Callable[[Dict[str, Any]], Awaitable[Any]]
+LoadOffset = Callable[[], Awaitable[Optional[int]]]
+SaveOffset = Callable[[int], Awaitable[Any]]
+
+
+def update_chat_key(update: Dict[str, Any]) -> Optional[int]:
+    """Key that defines ordering: updates from one chat are handled one after another."""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        msg = update.get(field)
+        if msg:
+            return msg.get("chat", {}).get("id")
+    cq = update.get("callback_query")
+    if cq:
+        chat = (cq.get("message") or {}).get("chat") or {}
+        return chat.get("id") or cq.get("from", {}).get("id")
+    for field in ("inline_query", "pre_checkout_query", "shipping_query", "my_chat_member", "chat_member"):
+        obj = update.get(field)
+        if obj:
+            return (obj.get("chat") or obj.get("from") or {}).get("id")
+    return None
+
+
+class UpdatePoller:
+    """getUpdates long-polling loop (alternative to the webhook).
+
+    Fetching never waits for handlers: every update is chained behind the previous
+    update of its chat, so one chat keeps its order while a slow reply (an LLM call)
+    holds up neither other chats nor the next getUpdates. At most `max_concurrency`
+    handlers run at once and at most `max_pending` updates are in flight; past that
+    fetching pauses. The persisted offset is the lowest update_id still in flight
+    (everything below it is handled), saved as it advances.
+
+    Adaptive timeout: while Telegram returns full batches (a backlog is being drained)
+    we poll with timeout=0, otherwise we long-poll with `max_timeout`. Errors, including
+    deleteWebhook / offset loading at startup, back off exponentially up to 30s.
+    """
+
+    def __init__(
+        self,
+        tg: TelegramAPI,
+        handler: UpdateHandler,
+        load_offset: LoadOffset,
+        save_offset: SaveOffset,
+        limit: int = 100,
+        max_timeout: int = 50,
+        max_concurrency: int = 32,
+        max_pending: int = 1000,
+    ):
+        self.tg = tg
+        self.handler = handler
+        self.load_offset = load_offset
+        self.save_offset = save_offset
+        self.limit = max(1, min(limit, 100))
+        self.max_timeout = max_timeout
+        self.max_pending = max(1, max_pending)
+        self._sem = asyncio.Semaphore(max_concurrency)
+        self._stopped = asyncio.Event()
+        self._offset: Optional[int] = None  # next update_id to fetch
+        self._saved_offset: Optional[int] = None
+        self._pending: Set[int] = set()  # update_ids fetched but not handled yet
+        self._tails: Dict[Any, asyncio.Task] = {}  # chat key -> its last queued update
+        self._room = asyncio.Event()  # fewer than max_pending in flight
+        self._room.set()
+        self._advanced = asyncio.Event()  # the handled offset may have moved
+
+    def stop(self):
+        self._stopped.set()
+
+    def handled_offset(self) -> Optional[int]:
+        """Offset below which every update is handled."""
+        return min(self._pending) if self._pending else self._offset
+
+    async def run(self):
+        started = False
+        saver: Optional[asyncio.Task] = None
+        timeout = self.max_timeout
+        backoff = 1.0
+        try:
+            while not self._stopped.is_set():
+                try:
+                    if not started:
+                        # Telegram or the database may still be unreachable at boot: retried like getUpdates
+                        await self.tg.delete_webhook()
+                        self._offset = self._saved_offset = await self.load_offset()
+                        started = True
+                        saver = asyncio.create_task(self._save_loop())
+                    await self._room.wait()
+                    updates = await self.tg.get_updates(offset=self._offset, timeout=timeout, limit=self.limit)
+                    for upd in updates:
+                        self._dispatch(upd)
+                    if updates:
+                        self._offset = updates[-1]["update_id"] + 1
+                        self._advanced.set()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    log.warning("polling failed: %s (retry in %.0fs)", e, backoff)
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 30.0)
+                    continue
+                backoff = 1.0
+                timeout = 0 if len(updates) >= self.limit else self.max_timeout
+        finally:
+            if saver is not None:
+                saver.cancel()
+
+    def _dispatch(self, upd: Dict[str, Any]):
+        update_id = upd["update_id"]
+        key = update_chat_key(upd)
+        # updates without a chat have no ordering constraint
+        if key is None:
+            key = ("update", update_id)
+        task = asyncio.create_task(self._handle(upd, self._tails.get(key)))
+        self._tails[key] = task
+        self._pending.add(update_id)
+        if len(self._pending) >= self.max_pending:
+            self._room.clear()
+        task.add_done_callback(lambda t: self._done(key, update_id, t))
+
+    async def _handle(self, upd: Dict[str, Any], previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.wait([previous])  # its outcome is not ours to raise
+        async with self._sem:
+            try:
+                await self.handler(upd)
+            except Exception:
+                log.exception("update %s failed", upd.get("update_id"))
+
+    def _done(self, key: Any, update_id: int, task: asyncio.Task):
+        self._pending.discard(update_id)
+        if self._tails.get(key) is task:
+            del self._tails[key]
+        if len(self._pending) < self.max_pending:
+            self._room.set()
+        self._advanced.set()
+
+    async def _save_loop(self):
+        # coalesces: one write per wake-up however many updates finished meanwhile
+        while True:
+            await self._advanced.wait()
+            self._advanced.clear()
+            offset = self.handled_offset()
+            if offset is None or offset == self._saved_offset:
+                continue
+            try:
+                await self.save_offset(offset)
+                self._saved_offset = offset
+            except Exception as e:
+                log.warning("saving updates offset failed: %s", e)
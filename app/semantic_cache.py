@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+import orjson
+
+try:  # optional: only needed when SEMANTIC_CACHE_ENABLED=1
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+# punctuation goes, digits, arithmetic operators and decimal separators stay ("2+2" != "2-2")
+_NON_WORD_RE = re.compile(r"(?!(?<=\d)[.,](?=\d))[^\w\s+\-*/=%^<>×÷]")
+# numbers and operators must match exactly for a hit ("1234*5678" vs "1234*5679");
+# a hyphen between letters ("что-то") is not an operator
+_EXACT_RE = re.compile(r"\d+(?:[.,]\d+)?|[+*/=%^<>×÷]|(?<![^\W\d_])-|-(?![^\W\d_])")
+# fillers that don't change the question: "что ты умеешь" == "что умеешь"
+_FILLER_WORDS = frozenset("ты вы мне меня пожалуйста плиз а ну же ли бы вот please pls you me".split())
+
+
+def normalize_prompt(text: str) -> str:
+    text = _NON_WORD_RE.sub(" ", text.lower().replace("ё", "е"))
+    return " ".join(w for w in text.split() if w not in _FILLER_WORDS)
+
+
+def exact_key(normalized: str) -> int:
+    """Hash of the numbers and operators of a normalised prompt, in order (0 if none)."""
+    tokens = _EXACT_RE.findall(normalized)
+    return zlib.crc32(" ".join(tokens).encode()) if tokens else 0
+
+
+class NgramVectorizer:
+    """Hashed character n-gram embedding (signed feature hashing, L2-normalised).
+
+    Local and deterministic: no model, no network. Near-duplicate prompts
+    ("что ты умеешь" / "Что ты умеешь?") land close in cosine space.
+    """
+
+    def __init__(self, dim: int = 256, ngram_range=(2, 4)):
+        self.dim = dim
+        self.ngram_range = ngram_range
+
+    def vectorize(self, text: str):
+        return self.vectorize_normalized(normalize_prompt(text))
+
+    def vectorize_normalized(self, normalized: str):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        s = f" {normalized} "
+        lo, hi = self.ngram_range
+        for n in range(lo, hi + 1):
+            for i in range(len(s) - n + 1):
+                h = zlib.crc32(s[i:i + n].encode())
+                vec[h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        norm = float(np.linalg.norm(vec))
+        if norm > 0:
+            vec /= norm
+        return vec
+
+
+class SemanticCache:
+    """Bounded near-duplicate cache for chat answers.
+
+    Vectors live in one preallocated NumPy matrix. A brute-force scan of 100k rows
+    costs several ms, so rows are also bucketed by random-hyperplane LSH codes
+    (`tables` x `bits`); a lookup scores only the rows sharing a bucket with the
+    query, in one matrix product, and accepts the best one at >= `threshold` cosine
+    whose numbers and operators (`exact_key`) equal the query's. Full cache evicts the least recently used row. `maybe_persist()` writes an .npz
+    snapshot at most every `persist_every_s` seconds.
+    """
+
+    def __init__(self, capacity: int = 20000, threshold: float = 0.92, dim: int = 256, tables: int = 20, bits: int = 16,
+                 path: Optional[str] = None, persist_every_s: float = 300.0, models: Optional[Iterable[str]] = None, seed: int = 1337):
+        if np is None:
+            raise RuntimeError("semantic cache needs numpy (pip install numpy)")
+        # None = every model; normally only cheap models are cached
+        self.cacheable_models = frozenset(models) if models else None
+        self.capacity = capacity
+        self.threshold = threshold
+        self.vectorizer = NgramVectorizer(dim)
+        self.path = path
+        self.persist_every_s = persist_every_s
+
+        self._planes = np.random.default_rng(seed).standard_normal((dim, tables * bits)).astype(np.float32)
+        self._pow2 = (1 << np.arange(bits, dtype=np.int64))
+        self._tables = tables
+        self._bits = bits
+
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._model_ids = np.full(capacity, -1, dtype=np.int32)
+        self._exact_keys = np.zeros(capacity, dtype=np.int64)
+        self._last_used = np.zeros(capacity, dtype=np.int64)  # 0 = free slot
+        self._codes = np.zeros((capacity, tables), dtype=np.int64)
+        self._answers: List[Optional[str]] = [None] * capacity
+        self._buckets: List[Dict[int, Set[int]]] = [{} for _ in range(tables)]
+        self._models: Dict[str, int] = {}
+        self._size = 0
+        self._tick = 0
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def accepts(self, model: str) -> bool:
+        return self.cacheable_models is None or model in self.cacheable_models
+
+    def _lsh_codes(self, vecs):
+        bits = (vecs @ self._planes) > 0
+        return bits.reshape(len(vecs), self._tables, self._bits) @ self._pow2
+
+    def _candidates(self, codes) -> "np.ndarray":
+        slots: Set[int] = set()
+        for t, code in enumerate(codes.tolist()):
+            bucket = self._buckets[t].get(code)
+            if bucket:
+                slots |= bucket
+        return np.fromiter(slots, dtype=np.int64, count=len(slots))
+
+    def lookup(self, model: str, prompt: str) -> Optional[str]:
+        model_id = self._models.get(model)
+        if model_id is None or not self._size:
+            return None
+        normalized = normalize_prompt(prompt)
+        vec = self.vectorizer.vectorize_normalized(normalized)
+        cand = self._candidates(self._lsh_codes(vec[None, :])[0])
+        if not len(cand):
+            return None
+        cand = cand[(self._model_ids[cand] == model_id) & (self._exact_keys[cand] == exact_key(normalized))]
+        if not len(cand):
+            return None
+        scores = self._vectors[cand] @ vec
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        slot = int(cand[best])
+        self._tick += 1
+        self._last_used[slot] = self._tick
+        return self._answers[slot]
+
+    def put(self, model: str, prompt: str, answer: str):
+        normalized = normalize_prompt(prompt)
+        vec = self.vectorizer.vectorize_normalized(normalized)
+        if not vec.any():
+            return
+        self._insert(self._models.setdefault(model, len(self._models)), vec, exact_key(normalized), answer)
+        self._dirty = True
+
+    def _insert(self, model_id: int, vec, key: int, answer: str, tick: Optional[int] = None):
+        if self._size < self.capacity:
+            slot = self._size
+            self._size += 1
+        else:
+            slot = int(np.argmin(self._last_used))
+            for t, code in enumerate(self._codes[slot].tolist()):
+                bucket = self._buckets[t].get(code)
+                if bucket:
+                    bucket.discard(slot)
+        codes = self._lsh_codes(vec[None, :])[0]
+        for t, code in enumerate(codes.tolist()):
+            self._buckets[t].setdefault(code, set()).add(slot)
+        self._vectors[slot] = vec
+        self._codes[slot] = codes
+        self._model_ids[slot] = model_id
+        self._exact_keys[slot] = key
+        self._answers[slot] = answer
+        if tick is None:
+            self._tick += 1
+            tick = self._tick
+        self._last_used[slot] = tick
+
+    # --- persistence ---
+
+    def _snapshot(self) -> Dict[str, Any]:
+        n = self._size
+        return {
+            "vectors": self._vectors[:n].copy(),
+            "model_ids": self._model_ids[:n].copy(),
+            "exact_keys": self._exact_keys[:n].copy(),
+            "last_used": self._last_used[:n].copy(),
+            # no pickle: answers and model names are stored as JSON bytes
+            "answers": np.frombuffer(orjson.dumps(self._answers[:n]), dtype=np.uint8),
+            "models": np.frombuffer(orjson.dumps(self._models), dtype=np.uint8),
+        }
+
+    @staticmethod
+    def _write(path: str, snapshot: Dict[str, Any]):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.tmp.npz"
+        np.savez(tmp, **snapshot)
+        os.replace(tmp, path)
+
+    def save(self):
+        if not self.path:
+            return
+        self._write(self.path, self._snapshot())
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    async def maybe_persist(self):
+        """Write a snapshot in a worker thread if there are changes and the interval passed."""
+        if not self.path or not self._dirty or time.monotonic() - self._saved_at < self.persist_every_s:
+            return
+        snapshot = self._snapshot()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        await asyncio.to_thread(self._write, self.path, snapshot)
+
+    def load(self) -> int:
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with np.load(self.path) as data:
+            vectors = data["vectors"]
+            # other dim, or a snapshot without exact keys: can't be matched safely
+            if vectors.shape[1] != self.vectorizer.dim or "exact_keys" not in data:
+                return 0
+            model_ids = data["model_ids"]
+            exact_keys = data["exact_keys"]
+            last_used = data["last_used"]
+            answers = orjson.loads(data["answers"].tobytes())
+            self._models = orjson.loads(data["models"].tobytes())
+        # most recent last, so a smaller capacity keeps the freshest rows
+        order = np.argsort(last_used)[-self.capacity:]
+        for i in order.tolist():
+            self._insert(int(model_ids[i]), vectors[i], int(exact_keys[i]), answers[i], tick=int(last_used[i]))
+        self._tick = max(self._tick, int(last_used.max()) if len(last_used) else 0)
+        return len(order)
+
+
+def create_semantic_cache(settings) -> Optional[SemanticCache]:
+    """SemanticCache from Settings (SEMANTIC_CACHE_*), or None when disabled."""
+    if not settings.SEMANTIC_CACHE_ENABLED:
+        return None
+    cache = SemanticCache(
+        capacity=settings.SEMANTIC_CACHE_SIZE,
+        threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+        path=settings.SEMANTIC_CACHE_PATH or None,
+        persist_every_s=settings.SEMANTIC_CACHE_SAVE_EVERY_S,
+        models=[m.strip() for m in settings.SEMANTIC_CACHE_MODELS.split(",") if m.strip()],
+    )
+    cache.load()
+    return cache
+
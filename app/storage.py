@@ -1,9 +1,17 @@
 from __future__ import annotations
+import os
+import time
 import aiosqlite
+from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterable, List, Tuple
 from datetime import datetime
 
+try:  # optional: only needed when DATABASE_URL points to Postgres
+    import asyncpg
+except ImportError:  # pragma: no cover
+    asyncpg = None
+
 @dataclass
 class User:
     tg_id: int
@@ -13,12 +21,246 @@ class User:
     credits_pro: int
     referred_by: Optional[int]
 
-class Storage:
-    def __init__(self, db_path: str):
+@dataclass
+class Broadcast:
+    id: int
+    admin_id: int
+    text: str
+    status: str  # running/done/cancelled
+    last_tg_id: int  # keyset checkpoint: every user with tg_id <= last_tg_id is handled
+    sent: int
+    failed: int
+    blocked: int
+    progress_message_id: Optional[int]
+    owner: Optional[str] = None  # worker holding the lease; only it runs and checkpoints the broadcast
+    lease_until: float = 0.0  # unix time
+
+# (tg_id, username, first_name, credits_free, referred_by)
+UserRow = Tuple[int, Optional[str], Optional[str], int, Optional[int]]
+
+class Storage(ABC):
+    """Storage interface. Implementations: SQLiteStorage (single process), PostgresStorage (multi-worker)."""
+
+    @abstractmethod
+    async def init(self):
+        ...
+
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def get_user(self, tg_id: int) -> Optional[User]:
+        ...
+
+    @abstractmethod
+    async def upsert_user(self, tg_id: int, username: Optional[str], first_name: Optional[str], credits_free: int, referred_by: Optional[int]):
+        ...
+
+    @abstractmethod
+    async def upsert_users(self, rows: Iterable[UserRow]):
+        """Batched upsert_user: one transaction for the whole batch."""
+        ...
+
+    @abstractmethod
+    async def register_user(self, tg_id: int, username: Optional[str], first_name: Optional[str], credits_free: int, referred_by: Optional[int], referrer_bonus: int) -> bool:
+        """Create the user and apply the referral in one transaction.
+
+        If the user is new and `referred_by` exists, the referrer gets `referrer_bonus`
+        free credits and its referral_stats counter is incremented.
+        Return False (and change nothing) if the user already exists.
+        """
+        ...
+
+    @abstractmethod
+    async def referral_count(self, tg_id: int) -> int:
+        ...
+
+    @abstractmethod
+    async def top_referrers(self, limit: int = 10) -> List[Tuple[int, int]]:
+        """[(tg_id, invited), ...] ordered by invited desc (index scan, no users scan)."""
+        ...
+
+    @abstractmethod
+    async def add_credits(self, tg_id: int, free_delta: int = 0, pro_delta: int = 0):
+        ...
+
+    @abstractmethod
+    async def consume_credit(self, tg_id: int) -> bool:
+        """Consume one credit. Prefer PRO credits, then free. Return True if consumed."""
+        ...
+
+    @abstractmethod
+    async def profile_with_jobs(self, tg_id: int, jobs_limit: int = 20) -> Tuple[Optional[User], List[Dict[str, Any]]]:
+        """User + its unfinished jobs (newest first) in one query. (None, []) if the user doesn't exist."""
+        ...
+
+    # --- generation jobs ---
+
+    @abstractmethod
+    async def create_job(self, tg_id: int, kind: str, request_id: Optional[str], status: str, upstream: Optional[str] = None, payload_json: Optional[str] = None) -> int:
+        """`upstream` names the ApiFree upstream that accepted the job: results are polled there."""
+        ...
+
+    @abstractmethod
+    async def get_job(self, tg_id: int, request_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def set_job_status(self, job_id: int, status: str):
+        ...
+
+    # --- bot state (key/value, e.g. getUpdates offset) ---
+
+    @abstractmethod
+    async def get_state(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set_state(self, key: str, value: str):
+        ...
+
+    # --- broadcasts ---
+
+    @abstractmethod
+    async def recipients_after(self, after_tg_id: int, limit: int) -> List[int]:
+        """Next `limit` non-blocked user ids with tg_id > after_tg_id (keyset pagination)."""
+        ...
+
+    @abstractmethod
+    async def count_recipients_after(self, after_tg_id: int) -> int:
+        ...
+
+    @abstractmethod
+    async def mark_blocked(self, tg_ids: Iterable[int]):
+        ...
+
+    @abstractmethod
+    async def unblock_user(self, tg_id: int):
+        ...
+
+    @abstractmethod
+    async def create_broadcast(self, admin_id: int, text: str, owner: str, lease_s: float) -> Broadcast:
+        """New running broadcast, already leased to `owner`."""
+        ...
+
+    @abstractmethod
+    async def claim_broadcast(self, broadcast_id: int, owner: str, lease_s: float) -> Optional[Broadcast]:
+        """Take or renew the lease of a running broadcast.
+
+        Succeeds when the lease expired or already belongs to `owner`. Return the
+        stored broadcast, None if it is not running or another worker holds it.
+        """
+        ...
+
+    @abstractmethod
+    async def save_broadcast(self, b: Broadcast, lease_s: float = 0.0) -> Optional[str]:
+        """Checkpoint status, cursor and counters and extend the lease by `lease_s`.
+
+        Only the lease owner (`b.owner`) writes, and a stored "cancelled" is never
+        overwritten. Return the stored status, None if the lease was lost.
+        """
+        ...
+
+    @abstractmethod
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Broadcast]:
+        ...
+
+    @abstractmethod
+    async def cancel_broadcasts(self) -> int:
+        """Mark all running broadcasts cancelled; their workers stop at the next lease renewal."""
+        ...
+
+    @abstractmethod
+    async def running_broadcasts(self) -> List[Broadcast]:
+        ...
+
+FINISHED_JOB_STATUSES = ("done", "failed", "error")
+
+# one-time fill for databases created before referral_stats existed;
+# ON CONFLICT: another worker starting at the same time may have filled it already
+_REFERRAL_STATS_BACKFILL_SQL = """
+    INSERT INTO referral_stats (tg_id, invited)
+    SELECT u.referred_by, COUNT(*) FROM users u
+    WHERE u.referred_by IS NOT NULL AND u.referred_by <> u.tg_id
+      AND EXISTS (SELECT 1 FROM users r WHERE r.tg_id = u.referred_by)
+    GROUP BY u.referred_by
+    ON CONFLICT (tg_id) DO NOTHING
+"""
+
+# pg_advisory_xact_lock key: serialises schema init of workers starting together
+_PG_SCHEMA_LOCK = 0x6B72_6973
+
+# user + unfinished jobs, one LEFT JOIN (placeholders differ per backend)
+_PROFILE_SQL = """
+    SELECT u.*, j.id AS job_id, j.kind, j.request_id, j.status, j.created_at AS job_created_at
+    FROM users u
+    LEFT JOIN jobs j ON j.tg_id = u.tg_id AND j.status NOT IN ({finished})
+    WHERE u.tg_id = {tg_id}
+    ORDER BY j.id DESC
+    LIMIT {limit}
+"""
+
+def _broadcast_from_row(row: Any) -> Broadcast:
+    return Broadcast(
+        id=row["id"],
+        admin_id=row["admin_id"],
+        text=row["text"],
+        status=row["status"],
+        last_tg_id=row["last_tg_id"],
+        sent=row["sent"],
+        failed=row["failed"],
+        blocked=row["blocked"],
+        progress_message_id=row["progress_message_id"],
+        owner=row["owner"],
+        lease_until=row["lease_until"],
+    )
+
+def _job_from_row(row: Any) -> Dict[str, Any]:
+    return {
+        "id": row["job_id"],
+        "kind": row["kind"],
+        "request_id": row["request_id"],
+        "status": row["status"],
+        "created_at": row["job_created_at"],
+    }
+
+def _job_dict(row: Any) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "tg_id": row["tg_id"],
+        "kind": row["kind"],
+        "request_id": row["request_id"],
+        "status": row["status"],
+        "upstream": row["upstream"],
+        "created_at": row["created_at"],
+    }
+
+def _user_from_row(row: Any) -> User:
+    return User(
+        tg_id=row["tg_id"],
+        username=row["username"],
+        first_name=row["first_name"],
+        credits_free=row["credits_free"],
+        credits_pro=row["credits_pro"],
+        referred_by=row["referred_by"],
+    )
+
+class SQLiteStorage(Storage):
+    def __init__(self, db_path: str, busy_timeout_s: float = 30.0):
         self.db_path = db_path
+        self.busy_timeout_s = busy_timeout_s
+
+    def _connect(self):
+        # wait for the writer lock instead of failing with "database is locked"
+        return aiosqlite.connect(self.db_path, timeout=self.busy_timeout_s)
 
     async def init(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        db_dir = os.path.dirname(self.db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        async with self._connect() as db:
+            # WAL: readers don't block the writer (persistent per database file)
+            await db.execute("PRAGMA journal_mode=WAL")
             await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 tg_id INTEGER PRIMARY KEY,
@@ -38,44 +280,129 @@ class Storage:
                 request_id TEXT,
                 status TEXT NOT NULL,
                 payload_json TEXT,
+                upstream TEXT,
                 created_at TEXT NOT NULL
             );
             """)
+            cur = await db.execute("SELECT 1 FROM pragma_table_info('jobs') WHERE name='upstream'")
+            if await cur.fetchone() is None:  # jobs created before upstream pinning
+                await db.execute("ALTER TABLE jobs ADD COLUMN upstream TEXT")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_tg_status ON jobs (tg_id, status)")
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS bot_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """)
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS referral_stats (
+                tg_id INTEGER PRIMARY KEY,
+                invited INTEGER NOT NULL DEFAULT 0
+            );
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_referral_stats_top ON referral_stats (invited DESC, tg_id)")
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS blocked_users (
+                tg_id INTEGER PRIMARY KEY,
+                blocked_at TEXT NOT NULL
+            );
+            """)
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL,
+                last_tg_id INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                progress_message_id INTEGER,
+                owner TEXT,
+                lease_until REAL NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL
+            );
+            """)
+            cur = await db.execute("SELECT 1 FROM referral_stats LIMIT 1")
+            if await cur.fetchone() is None:
+                await db.execute(_REFERRAL_STATS_BACKFILL_SQL)
             await db.commit()
 
     async def get_user(self, tg_id: int) -> Optional[User]:
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
             cur = await db.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,))
             row = await cur.fetchone()
             if not row:
                 return None
-            return User(
-                tg_id=row["tg_id"],
-                username=row["username"],
-                first_name=row["first_name"],
-                credits_free=row["credits_free"],
-                credits_pro=row["credits_pro"],
-                referred_by=row["referred_by"],
-            )
+            return _user_from_row(row)
+
+    _UPSERT_SQL = """
+        INSERT INTO users (tg_id, username, first_name, credits_free, credits_pro, referred_by, created_at)
+        VALUES (?, ?, ?, ?, 0, ?, ?)
+        ON CONFLICT(tg_id) DO UPDATE SET
+            username=excluded.username,
+            first_name=excluded.first_name
+    """
 
     async def upsert_user(self, tg_id: int, username: Optional[str], first_name: Optional[str], credits_free: int, referred_by: Optional[int]):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             now = datetime.utcnow().isoformat()
-            await db.execute(
+            await db.execute(self._UPSERT_SQL, (tg_id, username, first_name, credits_free, referred_by, now))
+            await db.commit()
+
+    async def upsert_users(self, rows: Iterable[UserRow]):
+        now = datetime.utcnow().isoformat()
+        async with self._connect() as db:
+            await db.executemany(self._UPSERT_SQL, [(*row, now) for row in rows])
+            await db.commit()
+
+    async def register_user(self, tg_id: int, username: Optional[str], first_name: Optional[str], credits_free: int, referred_by: Optional[int], referrer_bonus: int) -> bool:
+        now = datetime.utcnow().isoformat()
+        async with self._connect() as db:
+            cur = await db.execute(
                 """
                 INSERT INTO users (tg_id, username, first_name, credits_free, credits_pro, referred_by, created_at)
                 VALUES (?, ?, ?, ?, 0, ?, ?)
-                ON CONFLICT(tg_id) DO UPDATE SET
-                    username=excluded.username,
-                    first_name=excluded.first_name
+                ON CONFLICT(tg_id) DO NOTHING
                 """,
                 (tg_id, username, first_name, credits_free, referred_by, now),
             )
+            if cur.rowcount != 1:
+                await db.rollback()
+                return False
+            if referred_by and referred_by != tg_id:
+                await db.execute(
+                    "UPDATE users SET credits_free = credits_free + ? WHERE tg_id=?",
+                    (referrer_bonus, referred_by),
+                )
+                await db.execute(
+                    """
+                    INSERT INTO referral_stats (tg_id, invited)
+                    SELECT ?, 1 WHERE EXISTS (SELECT 1 FROM users WHERE tg_id=?)
+                    ON CONFLICT(tg_id) DO UPDATE SET invited = invited + 1
+                    """,
+                    (referred_by, referred_by),
+                )
             await db.commit()
+            return True
+
+    async def referral_count(self, tg_id: int) -> int:
+        async with self._connect() as db:
+            cur = await db.execute("SELECT invited FROM referral_stats WHERE tg_id=?", (tg_id,))
+            row = await cur.fetchone()
+            return row[0] if row else 0
+
+    async def top_referrers(self, limit: int = 10) -> List[Tuple[int, int]]:
+        async with self._connect() as db:
+            cur = await db.execute(
+                "SELECT tg_id, invited FROM referral_stats ORDER BY invited DESC, tg_id LIMIT ?",
+                (limit,),
+            )
+            return [(row[0], row[1]) for row in await cur.fetchall()]
 
     async def add_credits(self, tg_id: int, free_delta: int = 0, pro_delta: int = 0):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._connect() as db:
             await db.execute(
                 "UPDATE users SET credits_free = credits_free + ?, credits_pro = credits_pro + ? WHERE tg_id=?",
                 (free_delta, pro_delta, tg_id),
@@ -84,20 +411,451 @@ class Storage:
 
     async def consume_credit(self, tg_id: int) -> bool:
         """Consume one credit. Prefer PRO credits, then free. Return True if consumed."""
-        async with aiosqlite.connect(self.db_path) as db:
+        # single statement: no read-then-write race between workers
+        async with self._connect() as db:
+            cur = await db.execute(
+                """
+                UPDATE users SET
+                    credits_pro = credits_pro - CASE WHEN credits_pro > 0 THEN 1 ELSE 0 END,
+                    credits_free = credits_free - CASE WHEN credits_pro > 0 THEN 0 ELSE 1 END
+                WHERE tg_id=? AND (credits_pro > 0 OR credits_free > 0)
+                """,
+                (tg_id,),
+            )
+            await db.commit()
+            return cur.rowcount == 1
+
+    async def profile_with_jobs(self, tg_id: int, jobs_limit: int = 20) -> Tuple[Optional[User], List[Dict[str, Any]]]:
+        sql = _PROFILE_SQL.format(finished=", ".join("?" * len(FINISHED_JOB_STATUSES)), tg_id="?", limit="?")
+        async with self._connect() as db:
             db.row_factory = aiosqlite.Row
-            cur = await db.execute("SELECT credits_pro, credits_free FROM users WHERE tg_id=?", (tg_id,))
+            cur = await db.execute(sql, (*FINISHED_JOB_STATUSES, tg_id, jobs_limit))
+            rows = await cur.fetchall()
+        if not rows:
+            return None, []
+        return _user_from_row(rows[0]), [_job_from_row(r) for r in rows if r["job_id"] is not None]
+
+    async def create_job(self, tg_id: int, kind: str, request_id: Optional[str], status: str, upstream: Optional[str] = None, payload_json: Optional[str] = None) -> int:
+        async with self._connect() as db:
+            cur = await db.execute(
+                "INSERT INTO jobs (tg_id, kind, request_id, status, payload_json, upstream, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (tg_id, kind, request_id, status, payload_json, upstream, datetime.utcnow().isoformat()),
+            )
+            await db.commit()
+            return cur.lastrowid
+
+    async def get_job(self, tg_id: int, request_id: str) -> Optional[Dict[str, Any]]:
+        async with self._connect() as db:
+            db.row_factory = aiosqlite.Row
+            cur = await db.execute(
+                "SELECT * FROM jobs WHERE tg_id=? AND request_id=? ORDER BY id DESC LIMIT 1",
+                (tg_id, request_id),
+            )
             row = await cur.fetchone()
-            if not row:
-                return False
-            pro = row["credits_pro"]
-            free = row["credits_free"]
-            if pro > 0:
-                await db.execute("UPDATE users SET credits_pro = credits_pro - 1 WHERE tg_id=?", (tg_id,))
-                await db.commit()
-                return True
-            if free > 0:
-                await db.execute("UPDATE users SET credits_free = credits_free - 1 WHERE tg_id=?", (tg_id,))
-                await db.commit()
-                return True
-            return False
+            return _job_dict(row) if row else None
+
+    async def set_job_status(self, job_id: int, status: str):
+        async with self._connect() as db:
+            await db.execute("UPDATE jobs SET status=? WHERE id=?", (status, job_id))
+            await db.commit()
+
+    async def get_state(self, key: str) -> Optional[str]:
+        async with self._connect() as db:
+            cur = await db.execute("SELECT value FROM bot_state WHERE key=?", (key,))
+            row = await cur.fetchone()
+            return row[0] if row else None
+
+    async def set_state(self, key: str, value: str):
+        async with self._connect() as db:
+            await db.execute(
+                "INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                (key, value),
+            )
+            await db.commit()
+
+    async def recipients_after(self, after_tg_id: int, limit: int) -> List[int]:
+        async with self._connect() as db:
+            cur = await db.execute(
+                """
+                SELECT u.tg_id FROM users u
+                WHERE u.tg_id > ? AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.tg_id = u.tg_id)
+                ORDER BY u.tg_id LIMIT ?
+                """,
+                (after_tg_id, limit),
+            )
+            return [row[0] for row in await cur.fetchall()]
+
+    async def count_recipients_after(self, after_tg_id: int) -> int:
+        async with self._connect() as db:
+            cur = await db.execute(
+                """
+                SELECT COUNT(*) FROM users u
+                WHERE u.tg_id > ? AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.tg_id = u.tg_id)
+                """,
+                (after_tg_id,),
+            )
+            return (await cur.fetchone())[0]
+
+    async def mark_blocked(self, tg_ids: Iterable[int]):
+        now = datetime.utcnow().isoformat()
+        async with self._connect() as db:
+            await db.executemany(
+                "INSERT INTO blocked_users (tg_id, blocked_at) VALUES (?, ?) ON CONFLICT(tg_id) DO NOTHING",
+                [(tg_id, now) for tg_id in tg_ids],
+            )
+            await db.commit()
+
+    async def unblock_user(self, tg_id: int):
+        async with self._connect() as db:
+            await db.execute("DELETE FROM blocked_users WHERE tg_id=?", (tg_id,))
+            await db.commit()
+
+    async def create_broadcast(self, admin_id: int, text: str, owner: str, lease_s: float) -> Broadcast:
+        async with self._connect() as db:
+            db.row_factory = aiosqlite.Row
+            cur = await db.execute(
+                "INSERT INTO broadcasts (admin_id, text, status, owner, lease_until, created_at) VALUES (?, ?, 'running', ?, ?, ?)",
+                (admin_id, text, owner, time.time() + lease_s, datetime.utcnow().isoformat()),
+            )
+            cur = await db.execute("SELECT * FROM broadcasts WHERE id=?", (cur.lastrowid,))
+            row = await cur.fetchone()
+            await db.commit()
+            return _broadcast_from_row(row)
+
+    async def claim_broadcast(self, broadcast_id: int, owner: str, lease_s: float) -> Optional[Broadcast]:
+        now = time.time()
+        async with self._connect() as db:
+            db.row_factory = aiosqlite.Row
+            cur = await db.execute(
+                """
+                UPDATE broadcasts SET owner=?, lease_until=?
+                WHERE id=? AND status='running' AND (owner=? OR owner IS NULL OR lease_until < ?)
+                """,
+                (owner, now + lease_s, broadcast_id, owner, now),
+            )
+            if cur.rowcount != 1:
+                return None
+            cur = await db.execute("SELECT * FROM broadcasts WHERE id=?", (broadcast_id,))
+            row = await cur.fetchone()
+            await db.commit()
+            return _broadcast_from_row(row)
+
+    async def save_broadcast(self, b: Broadcast, lease_s: float = 0.0) -> Optional[str]:
+        async with self._connect() as db:
+            cur = await db.execute(
+                """
+                UPDATE broadcasts SET
+                    status = CASE WHEN status = 'cancelled' THEN status ELSE ? END,
+                    last_tg_id=?, sent=?, failed=?, blocked=?, progress_message_id=?,
+                    lease_until = MAX(lease_until, ?)
+                WHERE id=? AND owner=?
+                """,
+                (b.status, b.last_tg_id, b.sent, b.failed, b.blocked, b.progress_message_id, time.time() + lease_s, b.id, b.owner),
+            )
+            if cur.rowcount != 1:
+                await db.rollback()
+                return None
+            cur = await db.execute("SELECT status FROM broadcasts WHERE id=?", (b.id,))
+            row = await cur.fetchone()
+            await db.commit()
+            return row[0]
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Broadcast]:
+        async with self._connect() as db:
+            db.row_factory = aiosqlite.Row
+            cur = await db.execute("SELECT * FROM broadcasts WHERE id=?", (broadcast_id,))
+            row = await cur.fetchone()
+            return _broadcast_from_row(row) if row else None
+
+    async def cancel_broadcasts(self) -> int:
+        async with self._connect() as db:
+            cur = await db.execute("UPDATE broadcasts SET status='cancelled' WHERE status='running'")
+            await db.commit()
+            return cur.rowcount
+
+    async def running_broadcasts(self) -> List[Broadcast]:
+        async with self._connect() as db:
+            db.row_factory = aiosqlite.Row
+            cur = await db.execute("SELECT * FROM broadcasts WHERE status='running' ORDER BY id")
+            return [_broadcast_from_row(row) for row in await cur.fetchall()]
+
+class PostgresStorage(Storage):
+    """asyncpg-backed storage with a connection pool. Safe for several uvicorn workers / instances."""
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10):
+        if asyncpg is None:
+            raise RuntimeError("DATABASE_URL points to Postgres, but asyncpg is not installed (pip install asyncpg)")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool: Optional["asyncpg.Pool"] = None
+
+    async def init(self):
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+        async with self.pool.acquire() as conn, conn.transaction():
+            # concurrent CREATE TABLE IF NOT EXISTS can still fail on the catalog's unique index
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", _PG_SCHEMA_LOCK)
+            await conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                tg_id BIGINT PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                credits_free INTEGER NOT NULL DEFAULT 0,
+                credits_pro INTEGER NOT NULL DEFAULT 0,
+                referred_by BIGINT,
+                created_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                id BIGSERIAL PRIMARY KEY,
+                tg_id BIGINT NOT NULL,
+                kind TEXT NOT NULL, -- chat/image/video
+                request_id TEXT,
+                status TEXT NOT NULL,
+                payload_json TEXT,
+                upstream TEXT,
+                created_at TEXT NOT NULL
+            );
+            ALTER TABLE jobs ADD COLUMN IF NOT EXISTS upstream TEXT;
+            CREATE INDEX IF NOT EXISTS idx_jobs_tg_status ON jobs (tg_id, status);
+            CREATE TABLE IF NOT EXISTS bot_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS referral_stats (
+                tg_id BIGINT PRIMARY KEY,
+                invited INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_referral_stats_top ON referral_stats (invited DESC, tg_id);
+            CREATE TABLE IF NOT EXISTS blocked_users (
+                tg_id BIGINT PRIMARY KEY,
+                blocked_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id BIGSERIAL PRIMARY KEY,
+                admin_id BIGINT NOT NULL,
+                text TEXT NOT NULL,
+                status TEXT NOT NULL,
+                last_tg_id BIGINT NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                progress_message_id BIGINT,
+                owner TEXT,
+                lease_until DOUBLE PRECISION NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL
+            );
+            """)
+            if await conn.fetchval("SELECT 1 FROM referral_stats LIMIT 1") is None:
+                await conn.execute(_REFERRAL_STATS_BACKFILL_SQL)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def get_user(self, tg_id: int) -> Optional[User]:
+        row = await self.pool.fetchrow("SELECT * FROM users WHERE tg_id=$1", tg_id)
+        if not row:
+            return None
+        return _user_from_row(row)
+
+    async def upsert_user(self, tg_id: int, username: Optional[str], first_name: Optional[str], credits_free: int, referred_by: Optional[int]):
+        await self.upsert_users([(tg_id, username, first_name, credits_free, referred_by)])
+
+    async def upsert_users(self, rows: Iterable[UserRow]):
+        rows = list(rows)
+        if not rows:
+            return
+        ids, usernames, first_names, credits, referrers = (list(col) for col in zip(*rows))
+        # one round trip for the whole batch
+        await self.pool.execute(
+            """
+            INSERT INTO users (tg_id, username, first_name, credits_free, credits_pro, referred_by, created_at)
+            SELECT t.tg_id, t.username, t.first_name, t.credits_free, 0, t.referred_by, $6
+            FROM unnest($1::bigint[], $2::text[], $3::text[], $4::int[], $5::bigint[])
+                AS t(tg_id, username, first_name, credits_free, referred_by)
+            ON CONFLICT (tg_id) DO UPDATE SET
+                username=excluded.username,
+                first_name=excluded.first_name
+            """,
+            ids, usernames, first_names, credits, referrers, datetime.utcnow().isoformat(),
+        )
+
+    async def register_user(self, tg_id: int, username: Optional[str], first_name: Optional[str], credits_free: int, referred_by: Optional[int], referrer_bonus: int) -> bool:
+        # one statement = one round trip and one atomic transaction
+        created = await self.pool.fetchval(
+            """
+            WITH new_user AS (
+                INSERT INTO users (tg_id, username, first_name, credits_free, credits_pro, referred_by, created_at)
+                VALUES ($1, $2, $3, $4, 0, $5, $6)
+                ON CONFLICT (tg_id) DO NOTHING
+                RETURNING tg_id, referred_by
+            ), referrer AS (
+                UPDATE users SET credits_free = credits_free + $7
+                WHERE tg_id = (SELECT referred_by FROM new_user) AND tg_id <> $1
+                RETURNING tg_id
+            ), stats AS (
+                INSERT INTO referral_stats (tg_id, invited)
+                SELECT tg_id, 1 FROM referrer
+                ON CONFLICT (tg_id) DO UPDATE SET invited = referral_stats.invited + 1
+            )
+            SELECT count(*) FROM new_user
+            """,
+            tg_id, username, first_name, credits_free, referred_by, datetime.utcnow().isoformat(), referrer_bonus,
+        )
+        return created == 1
+
+    async def referral_count(self, tg_id: int) -> int:
+        invited = await self.pool.fetchval("SELECT invited FROM referral_stats WHERE tg_id=$1", tg_id)
+        return invited or 0
+
+    async def top_referrers(self, limit: int = 10) -> List[Tuple[int, int]]:
+        rows = await self.pool.fetch(
+            "SELECT tg_id, invited FROM referral_stats ORDER BY invited DESC, tg_id LIMIT $1",
+            limit,
+        )
+        return [(row["tg_id"], row["invited"]) for row in rows]
+
+    async def add_credits(self, tg_id: int, free_delta: int = 0, pro_delta: int = 0):
+        await self.pool.execute(
+            "UPDATE users SET credits_free = credits_free + $1, credits_pro = credits_pro + $2 WHERE tg_id=$3",
+            free_delta, pro_delta, tg_id,
+        )
+
+    async def consume_credit(self, tg_id: int) -> bool:
+        """Consume one credit. Prefer PRO credits, then free. Return True if consumed."""
+        row = await self.pool.fetchrow(
+            """
+            UPDATE users SET
+                credits_pro = credits_pro - CASE WHEN credits_pro > 0 THEN 1 ELSE 0 END,
+                credits_free = credits_free - CASE WHEN credits_pro > 0 THEN 0 ELSE 1 END
+            WHERE tg_id=$1 AND (credits_pro > 0 OR credits_free > 0)
+            RETURNING tg_id
+            """,
+            tg_id,
+        )
+        return row is not None
+
+    async def profile_with_jobs(self, tg_id: int, jobs_limit: int = 20) -> Tuple[Optional[User], List[Dict[str, Any]]]:
+        sql = _PROFILE_SQL.format(finished="SELECT unnest($1::text[])", tg_id="$2", limit="$3")
+        rows = await self.pool.fetch(sql, list(FINISHED_JOB_STATUSES), tg_id, jobs_limit)
+        if not rows:
+            return None, []
+        return _user_from_row(rows[0]), [_job_from_row(r) for r in rows if r["job_id"] is not None]
+
+    async def create_job(self, tg_id: int, kind: str, request_id: Optional[str], status: str, upstream: Optional[str] = None, payload_json: Optional[str] = None) -> int:
+        return await self.pool.fetchval(
+            """
+            INSERT INTO jobs (tg_id, kind, request_id, status, payload_json, upstream, created_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $7) RETURNING id
+            """,
+            tg_id, kind, request_id, status, payload_json, upstream, datetime.utcnow().isoformat(),
+        )
+
+    async def get_job(self, tg_id: int, request_id: str) -> Optional[Dict[str, Any]]:
+        row = await self.pool.fetchrow(
+            "SELECT * FROM jobs WHERE tg_id=$1 AND request_id=$2 ORDER BY id DESC LIMIT 1",
+            tg_id, request_id,
+        )
+        return _job_dict(row) if row else None
+
+    async def set_job_status(self, job_id: int, status: str):
+        await self.pool.execute("UPDATE jobs SET status=$1 WHERE id=$2", status, job_id)
+
+    async def get_state(self, key: str) -> Optional[str]:
+        return await self.pool.fetchval("SELECT value FROM bot_state WHERE key=$1", key)
+
+    async def set_state(self, key: str, value: str):
+        await self.pool.execute(
+            "INSERT INTO bot_state (key, value) VALUES ($1, $2) ON CONFLICT (key) DO UPDATE SET value=excluded.value",
+            key, value,
+        )
+
+    async def recipients_after(self, after_tg_id: int, limit: int) -> List[int]:
+        rows = await self.pool.fetch(
+            """
+            SELECT u.tg_id FROM users u
+            WHERE u.tg_id > $1 AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.tg_id = u.tg_id)
+            ORDER BY u.tg_id LIMIT $2
+            """,
+            after_tg_id, limit,
+        )
+        return [row["tg_id"] for row in rows]
+
+    async def count_recipients_after(self, after_tg_id: int) -> int:
+        return await self.pool.fetchval(
+            """
+            SELECT COUNT(*) FROM users u
+            WHERE u.tg_id > $1 AND NOT EXISTS (SELECT 1 FROM blocked_users b WHERE b.tg_id = u.tg_id)
+            """,
+            after_tg_id,
+        )
+
+    async def mark_blocked(self, tg_ids: Iterable[int]):
+        ids = list(tg_ids)
+        if not ids:
+            return
+        await self.pool.execute(
+            """
+            INSERT INTO blocked_users (tg_id, blocked_at)
+            SELECT unnest($1::bigint[]), $2
+            ON CONFLICT (tg_id) DO NOTHING
+            """,
+            ids, datetime.utcnow().isoformat(),
+        )
+
+    async def unblock_user(self, tg_id: int):
+        await self.pool.execute("DELETE FROM blocked_users WHERE tg_id=$1", tg_id)
+
+    async def create_broadcast(self, admin_id: int, text: str, owner: str, lease_s: float) -> Broadcast:
+        row = await self.pool.fetchrow(
+            """
+            INSERT INTO broadcasts (admin_id, text, status, owner, lease_until, created_at)
+            VALUES ($1, $2, 'running', $3, $4, $5) RETURNING *
+            """,
+            admin_id, text, owner, time.time() + lease_s, datetime.utcnow().isoformat(),
+        )
+        return _broadcast_from_row(row)
+
+    async def claim_broadcast(self, broadcast_id: int, owner: str, lease_s: float) -> Optional[Broadcast]:
+        now = time.time()
+        row = await self.pool.fetchrow(
+            """
+            UPDATE broadcasts SET owner=$2, lease_until=$3
+            WHERE id=$1 AND status='running' AND (owner=$2 OR owner IS NULL OR lease_until < $4)
+            RETURNING *
+            """,
+            broadcast_id, owner, now + lease_s, now,
+        )
+        return _broadcast_from_row(row) if row else None
+
+    async def save_broadcast(self, b: Broadcast, lease_s: float = 0.0) -> Optional[str]:
+        return await self.pool.fetchval(
+            """
+            UPDATE broadcasts SET
+                status = CASE WHEN status = 'cancelled' THEN status ELSE $1 END,
+                last_tg_id=$2, sent=$3, failed=$4, blocked=$5, progress_message_id=$6,
+                lease_until = GREATEST(lease_until, $7)
+            WHERE id=$8 AND owner=$9
+            RETURNING status
+            """,
+            b.status, b.last_tg_id, b.sent, b.failed, b.blocked, b.progress_message_id, time.time() + lease_s, b.id, b.owner,
+        )
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Broadcast]:
+        row = await self.pool.fetchrow("SELECT * FROM broadcasts WHERE id=$1", broadcast_id)
+        return _broadcast_from_row(row) if row else None
+
+    async def cancel_broadcasts(self) -> int:
+        result = await self.pool.execute("UPDATE broadcasts SET status='cancelled' WHERE status='running'")
+        return int(result.split()[-1])
+
+    async def running_broadcasts(self) -> List[Broadcast]:
+        rows = await self.pool.fetch("SELECT * FROM broadcasts WHERE status='running' ORDER BY id")
+        return [_broadcast_from_row(row) for row in rows]
+
+def create_storage(database_url: str = "", db_path: str = "./data/app.db", pool_min: int = 1, pool_max: int = 10) -> Storage:
+    """Postgres if DATABASE_URL is a postgres:// DSN, SQLite at DB_PATH otherwise."""
+    if database_url.startswith(("postgres://", "postgresql://")):
+        return PostgresStorage(database_url, min_size=pool_min, max_size=pool_max)
+    return SQLiteStorage(db_path)
@@ -1,38 +1,82 @@
 from __future__ import annotations
 import httpx
-from typing import Any, Dict, Optional
+import orjson
+from typing import Any, Dict, List, Optional, Union
+
+# reply_markup: dict, or a pre-serialised JSON string (see bot_logic.MAIN_MENU)
+ReplyMarkup = Union[Dict[str, Any], str]
+
+class TelegramError(RuntimeError):
+    """Telegram API replied ok=false. `retry_after` is set on 429 (flood control)."""
+
+    def __init__(self, data: Dict[str, Any]):
+        super().__init__(f"Telegram API error: {data}")
+        self.data = data
+        self.error_code: Optional[int] = data.get("error_code")
+        self.description: str = data.get("description", "")
+        self.retry_after: Optional[float] = (data.get("parameters") or {}).get("retry_after")
 
 class TelegramAPI:
     def __init__(self, bot_token: str):
         self.bot_token = bot_token
         self.base = f"https://api.telegram.org/bot{bot_token}"
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _http(self) -> httpx.AsyncClient:
+        # shared keep-alive pool: broadcasts/polling send many requests back to back
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=60.0)
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     async def _post(self, method: str, json: Dict[str, Any]) -> Dict[str, Any]:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            r = await client.post(f"{self.base}/{method}", json=json)
-            data = r.json()
-            if not data.get("ok"):
-                raise RuntimeError(f"Telegram API error: {data}")
-            return data
+        r = await self._http().post(f"{self.base}/{method}", content=orjson.dumps(json), headers={"Content-Type": "application/json"})
+        data = orjson.loads(r.content)
+        if not data.get("ok"):
+            raise TelegramError(data)
+        return data
 
     async def _get(self, method: str, params: Optional[Dict[str, Any]]=None) -> Dict[str, Any]:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            r = await client.get(f"{self.base}/{method}", params=params)
-            data = r.json()
-            if not data.get("ok"):
-                raise RuntimeError(f"Telegram API error: {data}")
-            return data
+        r = await self._http().get(f"{self.base}/{method}", params=params)
+        data = orjson.loads(r.content)
+        if not data.get("ok"):
+            raise TelegramError(data)
+        return data
 
     async def set_webhook(self, url: str):
         return await self._post("setWebhook", {"url": url})
 
-    async def send_message(self, chat_id: int, text: str, reply_markup: Optional[Dict[str, Any]]=None, disable_web_page_preview: bool=True):
+    async def delete_webhook(self, drop_pending_updates: bool=False):
+        # getUpdates is refused by Telegram while a webhook is set
+        return await self._post("deleteWebhook", {"drop_pending_updates": drop_pending_updates})
+
+    async def get_updates(self, offset: Optional[int]=None, timeout: int=50, limit: int=100, allowed_updates: Optional[List[str]]=None) -> List[Dict[str, Any]]:
+        """Long-poll getUpdates. `timeout` is the server-side wait in seconds (keep it below the HTTP timeout)."""
+        params: Dict[str, Any] = {"timeout": timeout, "limit": limit}
+        if offset is not None:
+            params["offset"] = offset
+        if allowed_updates is not None:
+            params["allowed_updates"] = orjson.dumps(allowed_updates).decode()
+        data = await self._get("getUpdates", params)
+        return data.get("result", [])
+
+    async def send_message(self, chat_id: int, text: str, reply_markup: Optional[ReplyMarkup]=None, disable_web_page_preview: bool=True):
         payload: Dict[str, Any] = {"chat_id": chat_id, "text": text, "parse_mode": "HTML", "disable_web_page_preview": disable_web_page_preview}
         if reply_markup:
             payload["reply_markup"] = reply_markup
         return await self._post("sendMessage", payload)
 
-    async def send_photo(self, chat_id: int, photo_url: str, caption: Optional[str]=None, reply_markup: Optional[Dict[str, Any]]=None):
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, reply_markup: Optional[ReplyMarkup]=None):
+        payload: Dict[str, Any] = {"chat_id": chat_id, "message_id": message_id, "text": text, "parse_mode": "HTML", "disable_web_page_preview": True}
+        if reply_markup:
+            payload["reply_markup"] = reply_markup
+        return await self._post("editMessageText", payload)
+
+    async def send_photo(self, chat_id: int, photo_url: str, caption: Optional[str]=None, reply_markup: Optional[ReplyMarkup]=None):
         payload: Dict[str, Any] = {"chat_id": chat_id, "photo": photo_url, "parse_mode": "HTML"}
         if caption:
             payload["caption"] = caption
@@ -40,7 +84,7 @@ class TelegramAPI:
             payload["reply_markup"] = reply_markup
         return await self._post("sendPhoto", payload)
 
-    async def send_video(self, chat_id: int, video_url: str, caption: Optional[str]=None, reply_markup: Optional[Dict[str, Any]]=None):
+    async def send_video(self, chat_id: int, video_url: str, caption: Optional[str]=None, reply_markup: Optional[ReplyMarkup]=None):
         payload: Dict[str, Any] = {"chat_id": chat_id, "video": video_url, "parse_mode": "HTML"}
         if caption:
             payload["caption"] = caption
@@ -68,7 +112,7 @@ class TelegramAPI:
         }
         return await self._post("sendInvoice", req)
 
-    async def send_document(self, chat_id: int, document_url: str, caption: Optional[str]=None, reply_markup: Optional[Dict[str, Any]]=None):
+    async def send_document(self, chat_id: int, document_url: str, caption: Optional[str]=None, reply_markup: Optional[ReplyMarkup]=None):
         payload: Dict[str, Any] = {"chat_id": chat_id, "document": document_url, "parse_mode": "HTML"}
         if caption:
             payload["caption"] = caption
@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+from typing import Any, Dict, Optional
+
+# Compact typed views of Telegram updates: only the fields the handlers use,
+# extracted once instead of repeated nested dict lookups per branch.
+
+
+class TgUser:
+    __slots__ = ("id", "username", "first_name")
+
+    def __init__(self, id: int, username: Optional[str] = None, first_name: Optional[str] = None):
+        self.id = id
+        self.username = username
+        self.first_name = first_name
+
+
+class Update:
+    __slots__ = ("update_id", "chat_id", "from_user", "text", "callback_id", "callback_data", "bot_username")
+
+    def __init__(self):
+        self.update_id: int = 0
+        self.chat_id: Optional[int] = None
+        self.from_user: Optional[TgUser] = None
+        self.text: str = ""
+        self.callback_id: Optional[str] = None  # set for callback_query updates
+        self.callback_data: str = ""
+        self.bot_username: Optional[str] = None
+
+    @property
+    def is_message(self) -> bool:
+        return self.callback_id is None and self.chat_id is not None
+
+    @property
+    def is_callback(self) -> bool:
+        return self.callback_id is not None
+
+
+def _user(obj: Optional[Dict[str, Any]]) -> Optional[TgUser]:
+    if not obj:
+        return None
+    return TgUser(obj["id"], obj.get("username"), obj.get("first_name"))
+
+
+def parse_update(data: Dict[str, Any]) -> Update:
+    u = Update()
+    u.update_id = data.get("update_id", 0)
+    u.bot_username = data.get("bot_username")
+    msg = data.get("message")
+    if msg is not None:
+        u.chat_id = msg["chat"]["id"]
+        u.from_user = _user(msg.get("from"))
+        u.text = msg.get("text") or ""
+        return u
+    cq = data.get("callback_query")
+    if cq is not None:
+        u.callback_id = cq["id"]
+        u.callback_data = cq.get("data") or ""
+        u.from_user = _user(cq.get("from"))
+        cq_msg = cq.get("message")
+        u.chat_id = cq_msg["chat"]["id"] if cq_msg else (u.from_user.id if u.from_user else None)
+    return u
@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import hashlib
+import hmac
+import json
+import time
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qsl
+
+
+@lru_cache(maxsize=8)
+def _secret_key(bot_token: str) -> bytes:
+    # https://core.telegram.org/bots/webapps#validating-data-received-via-the-mini-app
+    return hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+
+
+@lru_cache(maxsize=4096)
+def _check_signature(init_data: str, bot_token: str) -> Optional[Tuple[Dict[str, Any], int]]:
+    """HMAC check of Telegram.WebApp.initData -> (user, auth_date) or None.
+
+    Cached: the Mini App sends the same initData string with every request of a session.
+    """
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop("hash", "")
+    if not received_hash:
+        return None
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    expected = hmac.new(_secret_key(bot_token), check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received_hash):
+        return None
+    try:
+        user = json.loads(fields.get("user", "{}"))
+        auth_date = int(fields.get("auth_date", "0"))
+    except ValueError:
+        return None
+    if not user.get("id"):
+        return None
+    return user, auth_date
+
+
+def verify_init_data(init_data: str, bot_token: str, max_age_s: int = 86400) -> Optional[Dict[str, Any]]:
+    """Return the Telegram user from a valid, fresh initData, else None."""
+    if not init_data or not bot_token:
+        return None
+    checked = _check_signature(init_data, bot_token)
+    if checked is None:
+        return None
+    user, auth_date = checked
+    # freshness is checked outside the cache
+    if max_age_s and time.time() - auth_date > max_age_s:
+        return None
+    return user
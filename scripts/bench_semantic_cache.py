@@ -0,0 +1,47 @@
+"""SemanticCache lookup latency at N entries (default 100k) + near-duplicate hit check.
+
+Usage: python scripts/bench_semantic_cache.py [entries]
+"""
+from __future__ import annotations
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.semantic_cache import SemanticCache  # noqa: E402
+
+WORDS = (
+    "что ты умеешь как сделать фото видео музыка песня нарисуй кота собаку закат море горы город "
+    "напиши стих рецепт борща переведи текст на английский объясни квантовую физику code python "
+    "привет помоги с задачей сколько стоит подписка где купить лучший способ идея для бизнеса"
+).split()
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rnd = random.Random(0)
+    cache = SemanticCache(capacity=entries)
+
+    t0 = time.perf_counter()
+    for i in range(entries):
+        prompt = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 9))) + f" {i}"
+        cache.put("openai/gpt-5-mini", prompt, f"answer {i}")
+    cache.put("openai/gpt-5-mini", "что ты умеешь", "Я умею: чат, фото, видео, музыку")
+    print(f"filled {len(cache)} entries in {time.perf_counter() - t0:.1f}s")
+
+    queries = [" ".join(rnd.choice(WORDS) for _ in range(rnd.randint(3, 9))) for _ in range(2000)]
+    t0 = time.perf_counter()
+    for q in queries:
+        cache.lookup("openai/gpt-5-mini", q)
+    per_lookup = (time.perf_counter() - t0) / len(queries) * 1e3
+    print(f"lookup: {per_lookup:.3f} ms (avg over {len(queries)} queries)")
+
+    for q in ("что ты умеешь?", "Что ты умеешь", "ЧТО ТЫ УМЕЕШЬ!!", "Что умеешь"):
+        print(f"{q!r:>20} -> {cache.lookup('openai/gpt-5-mini', q)!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Per-update CPU of the webhook hot path: before (json + nested dicts) vs after (orjson + slotted Update).
+
+Covers what the service does per update without network I/O:
+decode the body, pull chat/user/text/callback fields, build the reply payload
+(main menu keyboard included) and encode it for httpx.
+
+Usage: python scripts/bench_updates.py [iterations]
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+# bot_logic reads settings at import time
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("PUBLIC_BASE_URL", "https://example.org")
+os.environ.setdefault("APIFREE_API_KEY", "bench")
+
+import orjson  # noqa: E402
+
+from app.bot_logic import MAIN_MENU, _webapp_url  # noqa: E402
+from app.updates import parse_update  # noqa: E402
+
+SAMPLES = [
+    {
+        "update_id": 1,
+        "message": {
+            "message_id": 10, "date": 1700000000, "text": "что ты умеешь?",
+            "chat": {"id": 111, "type": "private", "first_name": "Анна", "username": "anna"},
+            "from": {"id": 111, "is_bot": False, "first_name": "Анна", "username": "anna", "language_code": "ru"},
+        },
+    },
+    {
+        "update_id": 2,
+        "callback_query": {
+            "id": "4382", "data": "me:balance", "chat_instance": "-1",
+            "from": {"id": 222, "is_bot": False, "first_name": "Ivan", "language_code": "en"},
+            "message": {"message_id": 11, "date": 1700000001, "text": "Меню 👇",
+                        "chat": {"id": 222, "type": "private", "first_name": "Ivan"}},
+        },
+    },
+]
+BODIES = [json.dumps(s, ensure_ascii=False).encode() for s in SAMPLES]
+
+
+def _main_menu_dict(webapp_url: str):
+    # the keyboard as it was rebuilt for every reply
+    return {
+        "inline_keyboard": [
+            [{"text": "💬 ChatGPT", "callback_data": "mode:chat"}, {"text": "🖼 Фото", "callback_data": "mode:image"}],
+            [{"text": "🎬 Видео", "callback_data": "mode:video"}, {"text": "🎵 Музыка", "callback_data": "mode:music"}],
+            [{"text": "⚡ Mini‑App", "web_app": {"url": webapp_url}}],
+            [{"text": "🎁 Пригласить друга", "callback_data": "ref:share"}, {"text": "⭐ PRO (Stars)", "callback_data": "pro:buy"}],
+            [{"text": "ℹ️ Баланс", "callback_data": "me:balance"}, {"text": "🛟 Помощь", "callback_data": "help"}],
+        ]
+    }
+
+
+def before(body: bytes) -> bytes:
+    update = json.loads(body)
+    if "message" in update:
+        msg = update["message"]
+        chat_id = msg["chat"]["id"]
+        text = msg.get("text", "")
+        user_id = msg["from"]["id"]
+    else:
+        cq = update["callback_query"]
+        text = cq.get("data", "")
+        chat_id = cq["message"]["chat"]["id"]
+        user_id = cq["from"]["id"]
+    payload = {"chat_id": chat_id, "text": f"{user_id}: {text}", "parse_mode": "HTML",
+               "disable_web_page_preview": True, "reply_markup": _main_menu_dict(_webapp_url())}
+    return json.dumps(payload).encode()
+
+
+def after(body: bytes) -> bytes:
+    upd = parse_update(orjson.loads(body))
+    text = upd.text if upd.is_message else upd.callback_data
+    payload = {"chat_id": upd.chat_id, "text": f"{upd.from_user.id}: {text}", "parse_mode": "HTML",
+               "disable_web_page_preview": True, "reply_markup": MAIN_MENU}
+    return orjson.dumps(payload)
+
+
+def bench(fn, iterations: int) -> float:
+    for body in BODIES:  # warm-up
+        fn(body)
+    t0 = time.process_time()
+    for _ in range(iterations):
+        for body in BODIES:
+            fn(body)
+    return (time.process_time() - t0) / (iterations * len(BODIES)) * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    b = bench(before, iterations)
+    a = bench(after, iterations)
+    print(f"before: {b:6.2f} us/update  (json + dict lookups + keyboard rebuilt)")
+    print(f"after:  {a:6.2f} us/update  (orjson + slotted Update + pre-serialised keyboard)")
+    print(f"speedup: x{b / a:.2f}")
+
+
+if __name__ == "__main__":
+    main()
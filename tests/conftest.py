@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import os
+import uuid
+
+import pytest
+
+# app.config reads these at import time
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("PUBLIC_BASE_URL", "https://example.org")
+os.environ.setdefault("APIFREE_API_KEY", "test")
+
+from app.storage import PostgresStorage, SQLiteStorage, asyncpg  # noqa: E402
+
+# Postgres tests run against a local server, e.g.
+#   TEST_DATABASE_URL=postgresql://postgres@localhost:5432/postgres pytest
+# Every test gets its own schema, dropped afterwards.
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+
+async def _pg_connect():
+    if asyncpg is None:
+        pytest.skip("asyncpg is not installed")
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set (no local Postgres)")
+    try:
+        return await asyncpg.connect(TEST_DATABASE_URL, timeout=5)
+    except (OSError, asyncpg.PostgresError) as e:
+        pytest.skip(f"Postgres is not reachable: {e}")
+
+
+def _with_search_path(dsn: str, schema: str) -> str:
+    # asyncpg passes unknown DSN query parameters to the server as settings
+    return f"{dsn}{'&' if '?' in dsn else '?'}search_path={schema}"
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+async def storage(request, tmp_path):
+    if request.param == "sqlite":
+        s = SQLiteStorage(str(tmp_path / "app.db"))
+        await s.init()
+        yield s
+        await s.close()
+        return
+
+    conn = await _pg_connect()
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    await conn.execute(f"CREATE SCHEMA {schema}")
+    s = PostgresStorage(_with_search_path(TEST_DATABASE_URL, schema), min_size=1, max_size=4)
+    try:
+        await s.init()
+        yield s
+    finally:
+        await s.close()
+        await conn.execute(f"DROP SCHEMA {schema} CASCADE")
+        await conn.close()
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import httpx
+import orjson
+import pytest
+
+from app.apifree_client import ApiFreeClient, Upstream, UpstreamPool, extract_job_state, parse_upstreams
+
+A, B = "https://a.example", "https://b.example"
+
+
+def _client(handler, upstreams=((A, "KEY1"), (B, "KEY2"))) -> ApiFreeClient:
+    client = ApiFreeClient(A, "KEY1", upstreams=list(upstreams))
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client
+
+
+def _key(request: httpx.Request) -> str:
+    return request.headers["authorization"].split()[-1]
+
+
+def test_parse_upstreams():
+    assert parse_upstreams("https://a.example|K1|2, https://b.example|K2 ,broken,|K3") == [
+        ("https://a.example", "K1", 2.0),
+        ("https://b.example", "K2", 1.0),
+    ]
+    assert parse_upstreams("") == []
+
+
+def test_upstream_names_are_unique_and_hide_the_key():
+    a, b = Upstream(A, "first-key-1234"), Upstream(A, "second-key-1234")  # same URL, same key suffix
+    assert a.name != b.name
+    assert "1234" not in a.name.split("#")[1]
+    assert a.name == Upstream(A + "/", "first-key-1234").name  # stable across restarts
+    with pytest.raises(ValueError):
+        UpstreamPool([a, Upstream(A, "first-key-1234")])
+
+
+async def test_same_suffix_keys_are_polled_with_the_right_key():
+    keys = []
+
+    def handler(request):
+        keys.append(_key(request))
+        return httpx.Response(200, json={"resp_data": {"status": "running"}})
+
+    client = _client(handler, upstreams=((A, "first-key-1234"), (A, "second-key-1234")))
+    await client.image_result("r1", upstream=Upstream(A, "second-key-1234").name)
+    assert keys == ["second-key-1234"]
+    await client.aclose()
+
+
+@pytest.mark.parametrize("data, state", [
+    ({"resp_data": {"request_id": "r", "status": "queuing"}}, ("queuing", None)),
+    ({"resp_data": {"status": "success", "images": ["https://cdn/1.png"]}}, ("done", "https://cdn/1.png")),
+    ({"data": {"status": "SUCCEEDED", "videos": [{"url": "https://cdn/1.mp4"}]}}, ("done", "https://cdn/1.mp4")),
+    ({"audio_url": "https://cdn/1.mp3"}, ("done", "https://cdn/1.mp3")),
+    ({"status": "failed", "error": "nsfw"}, ("failed", None)),
+    ({}, ("pending", None)),
+])
+def test_extract_job_state(data, state):
+    assert extract_job_state(data) == state
+
+
+async def test_chat_fails_over_on_429():
+    keys = []
+
+    def handler(request):
+        keys.append(_key(request))
+        if _key(request) == "KEY1":
+            return httpx.Response(429, headers={"retry-after": "30"})
+        return httpx.Response(200, json={"choices": [{"message": {"content": "hi"}}]})
+
+    client = _client(handler)
+    assert await client.chat("m", [{"role": "user", "content": "hello"}]) == "hi"
+    assert await client.chat("m", [{"role": "user", "content": "hello"}]) == "hi"
+    assert keys == ["KEY1", "KEY2", "KEY2"]  # KEY1 cools down after its 429
+    await client.aclose()
+
+
+async def test_submit_does_not_fail_over_on_5xx():
+    keys = []
+
+    def handler(request):
+        keys.append(_key(request))
+        return httpx.Response(502)
+
+    client = _client(handler)
+    with pytest.raises(httpx.HTTPStatusError):
+        await client.image_submit({"prompt": "cat"})
+    assert len(keys) == 1  # the job may exist upstream: no duplicate on another key
+    await client.aclose()
+
+
+async def test_result_is_polled_on_the_persisted_upstream():
+    def submit(request):
+        if _key(request) == "KEY1":
+            return httpx.Response(429)
+        return httpx.Response(200, json={"resp_data": {"request_id": "r1", "status": "queuing"}})
+
+    client = _client(submit)
+    await client.image_submit({"prompt": "cat"})
+    upstream = client.upstream_for("r1")
+    assert upstream == Upstream(B, "KEY2").name
+    await client.aclose()
+
+    # another worker (or a restart): no pins, only the name stored with the job
+    polled = []
+
+    def result(request):
+        polled.append((str(request.url), _key(request)))
+        return httpx.Response(200, json={"resp_data": {"status": "success", "images": ["u"]}})
+
+    fresh = _client(result)
+    assert extract_job_state(await fresh.image_result("r1", upstream=upstream)) == ("done", "u")
+    assert polled == [(f"{B}/v1/image/r1/result", "KEY2")]
+    await fresh.aclose()
+
+
+@pytest.mark.parametrize("denied", [401, 403, 404])
+async def test_probe_goes_past_keys_that_dont_own_the_job(denied):
+    keys = []
+
+    def handler(request):
+        keys.append(_key(request))
+        if _key(request) == "KEY2":
+            return httpx.Response(200, json={"resp_data": {"status": "running"}})
+        return httpx.Response(denied, json={"error": "not yours"})
+
+    client = _client(handler, upstreams=((A, "KEY1"), (A, "KEY2")))
+    assert (await client.video_result("r1"))["resp_data"]["status"] == "running"
+    assert client.upstream_for("r1") == Upstream(A, "KEY2").name
+    await client.video_result("r1")
+    assert keys == ["KEY1", "KEY2", "KEY2"]
+    await client.aclose()
+
+
+async def test_probe_reports_real_error_over_not_owner():
+    def handler(request):
+        return httpx.Response(403 if _key(request) == "KEY1" else 500, content=orjson.dumps({}))
+
+    client = _client(handler)
+    with pytest.raises(httpx.HTTPStatusError) as e:
+        await client.image_result("r1")
+    assert e.value.response.status_code == 500
+    await client.aclose()
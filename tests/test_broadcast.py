@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+from app.broadcast import AdaptiveRateLimiter, Broadcaster
+from app.telegram_api import TelegramError
+
+
+class FakeTG:
+    def __init__(self, floods=None, blocked=(), delay: float = 0.0):
+        self.floods = dict(floods or {})  # tg_id -> number of 429s before success
+        self.blocked = set(blocked)
+        self.delay = delay
+        self.delivered = []
+        self.reports = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if text.startswith(("📣", "✅", "⛔")):
+            self.reports.append(text)
+            return {"result": {"message_id": 1}}
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.floods.get(chat_id):
+            self.floods[chat_id] -= 1
+            raise TelegramError({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                 "parameters": {"retry_after": 0.01}})
+        if chat_id in self.blocked:
+            raise TelegramError({"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"})
+        self.delivered.append(chat_id)
+        return {"result": {"message_id": 2}}
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.reports.append(text)
+
+
+def _broadcaster(storage, tg, **kwargs):
+    kwargs.setdefault("rate", 1000.0)
+    kwargs.setdefault("chunk_size", 10)
+    kwargs.setdefault("report_every_s", 0.0)
+    return Broadcaster(storage, tg, **kwargs)
+
+
+async def _wait(broadcaster: Broadcaster):
+    tasks = list(broadcaster._tasks.values())
+    if tasks:
+        await asyncio.wait_for(asyncio.gather(*tasks), 10)
+
+
+async def _users(storage, n: int):
+    await storage.upsert_users([(i, None, None, 0, None) for i in range(1, n + 1)])
+
+
+async def test_limiter_sleepers_honour_a_later_flood():
+    limiter = AdaptiveRateLimiter(max_rate=20.0)
+    await limiter.acquire()
+    t0 = time.monotonic()
+    # this sender is already asleep (slot at +50ms) when the 429 arrives
+    waiter = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    limiter.on_flood(0.3)
+    await waiter
+    assert time.monotonic() - t0 >= 0.29
+    assert limiter.rate < 20.0
+
+
+async def test_flood_is_retried_not_failed(storage):
+    await _users(storage, 25)
+    tg = FakeTG(floods={3: 4, 17: 7}, blocked={5, 20})
+    bc = _broadcaster(storage, tg)
+
+    b = await bc.start(admin_id=999, text="hello")
+    await _wait(bc)
+
+    stored = await storage.get_broadcast(b.id)
+    assert stored.status == "done"
+    assert (stored.sent, stored.failed, stored.blocked) == (23, 0, 2)
+    assert stored.last_tg_id == 25
+    assert sorted(tg.delivered) == [i for i in range(1, 26) if i not in (5, 20)]
+    assert await storage.recipients_after(0, 100) == [i for i in range(1, 26) if i not in (5, 20)]
+    assert tg.reports[-1].startswith("✅")
+
+
+async def test_running_broadcast_is_not_resumed_twice(storage):
+    await _users(storage, 30)
+    tg = FakeTG(delay=0.01)
+    worker_a = _broadcaster(storage, tg)
+    worker_b = _broadcaster(storage, tg)
+
+    b = await worker_a.start(admin_id=999, text="hello")
+    await worker_b.resume_pending()
+    assert worker_b._tasks == {}
+    await _wait(worker_a)
+
+    assert sorted(tg.delivered) == list(range(1, 31))
+    assert (await storage.get_broadcast(b.id)).status == "done"
+
+
+async def test_expired_lease_is_taken_over(storage):
+    await _users(storage, 12)
+    dead = await storage.create_broadcast(999, "hello", owner="dead-worker", lease_s=-1)
+    dead.last_tg_id, dead.sent = 4, 4
+    await storage.save_broadcast(dead)
+
+    tg = FakeTG()
+    bc = _broadcaster(storage, tg)
+    await bc.resume_pending()
+    await _wait(bc)
+
+    stored = await storage.get_broadcast(dead.id)
+    assert stored.owner == bc.owner
+    assert (stored.status, stored.sent, stored.last_tg_id) == ("done", 12, 12)
+    assert sorted(tg.delivered) == list(range(5, 13))
+    # the old owner can no longer write its checkpoint
+    assert await storage.save_broadcast(dead) is None
+
+
+async def test_stop_from_another_worker(storage):
+    await _users(storage, 200)
+    tg = FakeTG(delay=0.02)
+    worker_a = _broadcaster(storage, tg, rate=50.0, chunk_size=50, lease_s=0.3)
+    worker_b = _broadcaster(storage, tg, lease_s=0.3)
+
+    b = await worker_a.start(admin_id=999, text="hello")
+    await asyncio.sleep(0.2)
+    assert await worker_b.cancel_all() == 1
+    await _wait(worker_a)
+
+    stored = await storage.get_broadcast(b.id)
+    assert stored.status == "cancelled"
+    assert 0 < stored.sent < 200
+    # the cursor only covers recipients whose send completed
+    assert set(range(1, stored.last_tg_id + 1)) <= set(tg.delivered)
+    assert tg.reports[-1].startswith("⛔")
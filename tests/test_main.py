@@ -0,0 +1,353 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import hmac
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import bot_logic, broadcast, main, webapp_auth
+from app.assets import IMMUTABLE, REVALIDATE, AssetPipeline
+from app.storage import SQLiteStorage
+from app.telegram_api import TelegramError
+
+
+class FakeTG:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if re.search(r"<(?![/a-z])", text):  # parse_mode=HTML
+            raise TelegramError({"ok": False, "error_code": 400,
+                                 "description": "Bad Request: can't parse entities: unsupported start tag"})
+        self.sent.append((chat_id, text))
+        return {"result": {"message_id": len(self.sent)}}
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+class FakeApiFree:
+    semantic_cache = None
+
+    def __init__(self):
+        self.submitted = []
+        self.polled = []
+        self.submit_delay = 0.0
+        self.chat_delay = 0.0
+        self.submit_error: Optional[Exception] = None
+
+    async def chat(self, model, messages, **kwargs):
+        await asyncio.sleep(self.chat_delay)
+        return f"echo: {messages[-1]['content']}"
+
+    async def image_submit(self, payload):
+        await asyncio.sleep(self.submit_delay)
+        if self.submit_error is not None:
+            raise self.submit_error
+        self.submitted.append(payload)
+        return {"code": 200, "resp_data": {"request_id": "req-1", "status": "queuing"}}
+
+    async def song_submit(self, payload):
+        self.submitted.append(payload)
+        return {"data": {"status": "success", "audio_url": "https://cdn/song.mp3"}}
+
+    def upstream_for(self, request_id):
+        return "https://b.example#KEY2"
+
+    async def image_result(self, request_id, upstream=None):
+        self.polled.append((request_id, upstream))
+        return {"resp_data": {"status": "success", "image_list": [], "images": ["https://cdn/cat.png"]}}
+
+    async def aclose(self):
+        pass
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    storage = SQLiteStorage(str(tmp_path / "app.db"))
+    tg = FakeTG()
+    monkeypatch.setattr(main, "storage", storage)
+    monkeypatch.setattr(main, "tg", tg)
+    monkeypatch.setattr(main, "apifree", FakeApiFree())
+    monkeypatch.setattr(main, "UPDATES_MODE", "webhook")
+    monkeypatch.setattr(broadcast, "_broadcaster", None)
+    monkeypatch.setattr(bot_logic, "ADMIN_IDS", frozenset({1}))
+    with TestClient(main.app) as c:
+        c.storage, c.tg, c.apifree = storage, tg, main.apifree
+        yield c
+
+
+def _init_data(user_id: int, auth_date: Optional[float] = None, bot_token: Optional[str] = None) -> str:
+    """initData as Telegram signs it for the Mini App."""
+    auth_date = time.time() if auth_date is None else auth_date
+    fields = {"auth_date": str(int(auth_date)), "user": json.dumps({"id": user_id, "first_name": "U"})}
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", (bot_token or main.BOT_TOKEN).encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def _message(update_id: int, user_id: int, text: str):
+    user = {"id": user_id, "is_bot": False, "first_name": "U"}
+    return {"update_id": update_id, "message": {"message_id": update_id, "from": user, "chat": {"id": user_id}, "text": text}}
+
+
+async def _handled():
+    if main._update_tasks:
+        await asyncio.wait(main._update_tasks)
+
+
+def _webhook(client, update):
+    r = client.post("/telegram/webhook/hook", json=update)
+    client.portal.call(_handled)
+    return r
+
+
+def test_webhook_runs_bot_logic(client):
+    r = _webhook(client, _message(1, 5, "/start ref_1"))
+    assert r.json() == {"ok": True}
+    assert client.tg.sent[-1][0] == 5
+    assert "Привет" in client.tg.sent[-1][1]
+
+    r = client.get("/api/me", params={"tg_id": 5})
+    assert r.json()["free"] > 0
+
+
+def test_webhook_broadcast_commands(client):
+    _webhook(client, _message(1, 1, "/broadcast_stop"))
+    assert client.tg.sent[-1] == (1, "⛔ Остановлено рассылок: 0")
+
+    # not an admin: treated as a chat prompt, never as a broadcast
+    _webhook(client, _message(2, 7, "/broadcast_stop"))
+    assert client.tg.sent[-1] == (7, "echo: /broadcast_stop")
+
+
+def test_broadcast_text_is_previewed(client):
+    _webhook(client, _message(1, 1, "/broadcast скидка <b>50%</b>"))
+    assert client.tg.sent[-2] == (1, "скидка <b>50%</b>")
+    assert client.tg.sent[-1][1].startswith("📣 Рассылка #1 запущена")
+
+
+def test_broadcast_with_broken_html_is_not_started(client):
+    _webhook(client, _message(1, 1, "/broadcast скидка <50%"))
+    assert "Рассылка не запущена" in client.tg.sent[-1][1]
+    assert client.portal.call(client.storage.running_broadcasts) == []
+    assert client.portal.call(client.storage.get_broadcast, 1) is None
+
+
+def test_webhook_acks_before_the_reply(client):
+    _webhook(client, _message(1, 7, "/start"))
+    client.apifree.chat_delay = 0.5
+    r = client.post("/telegram/webhook/hook", json=_message(2, 7, "что ты умеешь"))
+    assert r.json() == {"ok": True}
+    assert main._update_tasks  # acked while the LLM reply is still on its way
+    assert not any(text.startswith("echo") for _, text in client.tg.sent)
+    client.portal.call(_handled)
+    assert client.tg.sent[-1] == (7, "echo: что ты умеешь")
+
+
+def test_webhook_ignores_garbage(client):
+    r = client.post("/telegram/webhook/hook", content=b"not json")
+    assert r.json() == {"ok": True}
+
+
+def _tampered(init_data: str, **changes) -> str:
+    fields = dict(parse_qsl(init_data))
+    fields.update(changes)
+    return urlencode({k: v for k, v in fields.items() if v is not None})
+
+
+@pytest.mark.parametrize("init_data", [
+    _tampered(_init_data(5), hash="0" * 64),
+    _tampered(_init_data(5), hash=None),
+    _tampered(_init_data(5), user=json.dumps({"id": 6, "first_name": "U"})),
+    _tampered(_init_data(5), auth_date=str(int(time.time()) + 60)),
+    _init_data(5, auth_date=time.time() - 86400 - 60),
+    _init_data(5, bot_token="1:other-bot"),
+    "garbage",
+])
+def test_bootstrap_rejects_bad_init_data(client, init_data):
+    r = client.get("/api/bootstrap", headers={"X-Telegram-Init-Data": init_data})
+    assert r.status_code == 401
+    assert client.post("/api/image/submit", json={"prompt": "кот"}, headers={"X-Telegram-Init-Data": init_data}).status_code == 401
+    assert client.portal.call(client.storage.get_user, 5) is None
+
+
+def test_cached_signature_still_expires(client, monkeypatch):
+    headers = {"X-Telegram-Init-Data": _init_data(5)}
+    assert client.get("/api/bootstrap", headers=headers).status_code == 200  # signature check now cached
+
+    now = time.time()
+    monkeypatch.setattr(webapp_auth.time, "time", lambda: now + 86400 + 60)
+    assert client.get("/api/bootstrap", headers=headers).status_code == 401
+
+
+def test_job_polls_the_upstream_that_accepted_it(client):
+    headers = {"X-Telegram-Init-Data": _init_data(5)}
+    client.get("/api/bootstrap", headers=headers)  # creates the user with signup credits
+
+    r = client.post("/api/image/submit", json={"prompt": "кот"}, headers=headers)
+    assert r.json() == {"job_id": "req-1", "status": "queuing", "url": None}
+    assert client.apifree.submitted[-1]["model"] == main.settings.APIFREE_IMAGE_MODEL
+
+    boot = client.get("/api/bootstrap", headers=headers).json()
+    assert [j["request_id"] for j in boot["jobs"]] == ["req-1"]
+    assert boot["me"]["free"] == main.settings.FREE_CREDITS_ON_SIGNUP - 1
+
+    r = client.get("/api/image/result/req-1", headers=headers)
+    assert r.json() == {"status": "done", "url": "https://cdn/cat.png"}
+    assert client.apifree.polled == [("req-1", "https://b.example#KEY2")]
+    assert client.get("/api/bootstrap", headers=headers).json()["jobs"] == []
+
+
+def test_job_endpoints_check_user(client):
+    headers = {"X-Telegram-Init-Data": _init_data(5)}
+    assert client.post("/api/image/submit", json={"prompt": "кот"}).status_code == 401
+    assert client.post("/api/image/submit", json={"prompt": "кот"}, headers=headers).status_code == 403  # no user yet
+    assert client.post("/api/sculpture/submit", json={}, headers=headers).status_code == 404
+
+    client.get("/api/bootstrap", headers=headers)
+    client.post("/api/image/submit", json={"prompt": "кот"}, headers=headers)
+    other = {"X-Telegram-Init-Data": _init_data(6)}
+    assert client.get("/api/image/result/req-1", headers=other).status_code == 404
+    assert client.get("/api/video/result/req-1", headers=headers).status_code == 404
+
+
+def test_one_credit_pays_for_one_job(client):
+    headers = {"X-Telegram-Init-Data": _init_data(5)}
+    client.get("/api/bootstrap", headers=headers)
+    client.portal.call(client.storage.add_credits, 5, 1 - main.settings.FREE_CREDITS_ON_SIGNUP)
+    client.apifree.submit_delay = 0.1  # every request is past the credit check before any submit returns
+
+    def submit(_):
+        return client.post("/api/image/submit", json={"prompt": "кот"}, headers=headers).status_code
+
+    with ThreadPoolExecutor(5) as pool:
+        codes = sorted(pool.map(submit, range(5)))
+    assert codes == [200, 403, 403, 403, 403]
+    assert len(client.apifree.submitted) == 1
+    assert client.get("/api/bootstrap", headers=headers).json()["me"]["free"] == 0
+
+
+def test_failed_submit_is_refunded(client):
+    headers = {"X-Telegram-Init-Data": _init_data(5)}
+    client.get("/api/bootstrap", headers=headers)
+    client.portal.call(client.storage.add_credits, 5, 0, 1)
+    client.apifree.submit_error = RuntimeError("ApiFree is down")
+
+    with pytest.raises(RuntimeError):
+        client.post("/api/image/submit", json={"prompt": "кот"}, headers=headers)
+    me = client.get("/api/bootstrap", headers=headers).json()["me"]
+    assert (me["free"], me["pro"]) == (main.settings.FREE_CREDITS_ON_SIGNUP, 1)
+
+
+def test_synchronous_job_result(client):
+    headers = {"X-Telegram-Init-Data": _init_data(5)}
+    client.get("/api/bootstrap", headers=headers)
+    r = client.post("/api/music/submit", json={"lyrics": "la", "style": "pop"}, headers=headers)
+    assert r.json() == {"status": "done", "url": "https://cdn/song.mp3"}
+    assert client.get("/api/bootstrap", headers=headers).json()["jobs"] == []
+
+
+APP_JS = b"console.log('mini app');\n" * 40
+
+
+@pytest.fixture
+def webapp(client, monkeypatch, tmp_path):
+    root = tmp_path / "webapp"
+    (root / "js").mkdir(parents=True)
+    (root / "index.html").write_text('<script src="/webapp/js/app.js"></script><script src="/webapp/a.js"></script>')
+    (root / "js" / "app.js").write_bytes(APP_JS)
+    (root / "a.js").write_bytes(b"1")
+    monkeypatch.setattr(main, "webapp_assets", AssetPipeline(str(root), url_prefix="/webapp").build())
+    return client
+
+
+def _hashed(client, name):
+    html = client.get("/webapp/").text
+    return re.search(rf"/webapp/({name}\.[0-9a-f]{{10}}\.js)", html).group(1)
+
+
+def test_webapp_index_points_to_hashed_names(webapp):
+    r = webapp.get("/webapp/", headers={"Accept-Encoding": "identity"})
+    assert r.headers["cache-control"] == REVALIDATE
+    assert r.headers["content-type"].startswith("text/html")
+    hashed_app, hashed_a = _hashed(webapp, "js/app"), _hashed(webapp, "a")
+    assert "/webapp/js/app.js" not in r.text and "/webapp/a.js" not in r.text
+
+    r = webapp.get(f"/webapp/{hashed_app}")
+    assert r.content == APP_JS
+    assert r.headers["cache-control"] == IMMUTABLE
+    assert webapp.get(f"/webapp/{hashed_a}").content == b"1"
+    # the plain name stays reachable for old cached pages, but must revalidate
+    r = webapp.get("/webapp/js/app.js")
+    assert r.content == APP_JS
+    assert r.headers["cache-control"] == REVALIDATE
+
+
+@pytest.mark.parametrize("accept, encoding", [
+    ("gzip", "gzip"),
+    ("gzip;q=0.5, identity", "gzip"),
+    ("gzip;q=0", None),
+    ("gzip; q=0.00", None),
+    ("GZIP;Q=0.000", None),
+    ("deflate", None),
+    ("", None),
+])
+def test_webapp_gzip_negotiation(webapp, accept, encoding):
+    r = webapp.get("/webapp/js/app.js", headers={"Accept-Encoding": accept})
+    assert r.headers.get("content-encoding") == encoding
+    assert r.headers["vary"] == "Accept-Encoding"
+    assert r.content == APP_JS  # httpx decodes gzip
+
+
+def test_webapp_brotli_is_preferred(webapp):
+    pytest.importorskip("brotli")
+    assert webapp.get("/webapp/js/app.js", headers={"Accept-Encoding": "gzip, br"}).headers["content-encoding"] == "br"
+    assert webapp.get("/webapp/js/app.js", headers={"Accept-Encoding": "gzip, br;q=0.0"}).headers["content-encoding"] == "gzip"
+
+
+def test_webapp_etag_per_encoding(webapp):
+    plain = webapp.get("/webapp/js/app.js", headers={"Accept-Encoding": "identity"})
+    gz = webapp.get("/webapp/js/app.js", headers={"Accept-Encoding": "gzip"})
+    assert plain.headers["etag"] != gz.headers["etag"]
+
+    r = webapp.get("/webapp/js/app.js", headers={"Accept-Encoding": "gzip", "If-None-Match": gz.headers["etag"]})
+    assert r.status_code == 304
+    assert r.content == b""
+    assert r.headers["etag"] == gz.headers["etag"]
+    assert r.headers["cache-control"] == REVALIDATE
+    # a tag of the other representation does not match
+    r = webapp.get("/webapp/js/app.js", headers={"Accept-Encoding": "gzip", "If-None-Match": plain.headers["etag"]})
+    assert r.status_code == 200
+    r = webapp.get("/webapp/js/app.js", headers={"Accept-Encoding": "identity", "If-None-Match": f'W/{plain.headers["etag"]}'})
+    assert r.status_code == 304
+
+
+def test_webapp_head(webapp):
+    get = webapp.get("/webapp/js/app.js", headers={"Accept-Encoding": "gzip"})
+    head = webapp.head("/webapp/js/app.js", headers={"Accept-Encoding": "gzip"})
+    assert head.status_code == 200
+    assert head.content == b""
+    assert head.headers["etag"] == get.headers["etag"]
+    assert head.headers["content-encoding"] == "gzip"
+    assert int(head.headers["content-length"]) < len(APP_JS)
+
+
+def test_webapp_unknown_path(webapp):
+    assert webapp.get("/webapp/missing.js").status_code == 404
+    assert webapp.get("/webapp/js/app.0123456789.js").status_code == 404
+    r = webapp.get("/webapp", follow_redirects=False)
+    assert r.status_code in (302, 307)
+    assert r.headers["location"] == "/webapp/"
@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from app import polling
+from app.polling import UpdatePoller, update_chat_key
+
+
+def _msg(update_id: int, chat_id: int, text: str = "hi"):
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "text": text}}
+
+
+class FakeTG:
+    def __init__(self, batches, fail_delete_webhook: int = 0):
+        self.batches = list(batches)
+        self.fail_delete_webhook = fail_delete_webhook
+        self.offsets = []
+
+    async def delete_webhook(self):
+        if self.fail_delete_webhook:
+            self.fail_delete_webhook -= 1
+            raise ConnectionError("telegram is down")
+
+    async def get_updates(self, offset=None, timeout=50, limit=100):
+        self.offsets.append(offset)
+        if self.batches:
+            return self.batches.pop(0)
+        await asyncio.sleep(3600)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    real_sleep = asyncio.sleep
+
+    async def fast_sleep(seconds, *args):
+        await real_sleep(0 if seconds < 3600 else seconds)
+
+    monkeypatch.setattr(polling.asyncio, "sleep", fast_sleep)
+
+
+async def _run_until(poller: UpdatePoller, cond):
+    task = asyncio.create_task(poller.run())
+    for _ in range(1000):
+        if cond():
+            break
+        await asyncio.sleep(0)
+    poller.stop()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+def test_update_chat_key():
+    assert update_chat_key(_msg(1, 5)) == 5
+    assert update_chat_key({"update_id": 1, "callback_query": {"from": {"id": 7}, "message": {"chat": {"id": 8}}}}) == 8
+    assert update_chat_key({"update_id": 1, "callback_query": {"from": {"id": 7}}}) == 7
+    assert update_chat_key({"update_id": 1, "poll": {}}) is None
+
+
+async def test_startup_failures_are_retried():
+    tg = FakeTG([[_msg(10, 1)]], fail_delete_webhook=2)
+    offset_loads = 0
+    saved = []
+    handled = []
+
+    async def load_offset():
+        nonlocal offset_loads
+        offset_loads += 1
+        if offset_loads == 1:
+            raise ConnectionError("database is down")
+        return 10
+
+    async def save_offset(offset):
+        saved.append(offset)
+
+    async def handler(update):
+        handled.append(update["update_id"])
+
+    poller = UpdatePoller(tg, handler, load_offset, save_offset)
+    await _run_until(poller, lambda: saved)
+
+    assert offset_loads == 2
+    assert tg.offsets[0] == 10
+    assert handled == [10]
+    assert saved == [11]
+
+
+async def test_batch_keeps_per_chat_order():
+    batch = [_msg(1, 1, "a"), _msg(2, 2, "x"), _msg(3, 1, "b"), _msg(4, 1, "c")]
+    tg = FakeTG([batch])
+    seen = []
+    saved = []
+
+    async def load_offset():
+        return None
+
+    async def save_offset(offset):
+        saved.append(offset)
+
+    async def handler(update):
+        if update["update_id"] == 1:
+            await asyncio.sleep(0)
+        seen.append((update["message"]["chat"]["id"], update["message"]["text"]))
+        if update["update_id"] == 3:
+            raise RuntimeError("handler bug")  # logged, the chat goes on
+
+    poller = UpdatePoller(tg, handler, load_offset, save_offset)
+    await _run_until(poller, lambda: saved and saved[-1] == 5)
+
+    assert [text for chat, text in seen if chat == 1] == ["a", "b", "c"]
+    assert saved == sorted(saved)
+    assert saved[-1] == 5
+
+
+async def test_slow_chat_does_not_hold_up_others():
+    # chat 1 waits for an LLM reply while chat 2 keeps talking over several batches
+    tg = FakeTG([[_msg(1, 1, "slow"), _msg(2, 2, "a")], [_msg(3, 2, "b")], [_msg(4, 1, "next"), _msg(5, 2, "c")]])
+    reply = asyncio.Event()
+    seen = []
+    saved = []
+
+    async def load_offset():
+        return None
+
+    async def save_offset(offset):
+        saved.append(offset)
+
+    async def handler(update):
+        if update["message"]["text"] == "slow":
+            await reply.wait()
+        seen.append(update["message"]["text"])
+
+    poller = UpdatePoller(tg, handler, load_offset, save_offset)
+    task = asyncio.create_task(poller.run())
+    for _ in range(1000):
+        if "c" in seen:
+            break
+        await asyncio.sleep(0)
+
+    assert seen == ["a", "b", "c"]
+    assert tg.offsets == [None, 3, 4, 6]
+    # update 1 is still in flight: nothing at or past it may be marked handled
+    assert poller.handled_offset() == 1
+    assert all(offset <= 1 for offset in saved)
+
+    reply.set()
+    for _ in range(1000):
+        if saved and saved[-1] == 6:
+            break
+        await asyncio.sleep(0)
+    assert seen == ["a", "b", "c", "slow", "next"]
+    assert saved[-1] == 6
+
+    poller.stop()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+async def test_fetching_pauses_when_too_many_are_pending():
+    tg = FakeTG([[_msg(1, 1), _msg(2, 2)], [_msg(3, 3)]])
+    release = asyncio.Event()
+
+    async def load_offset():
+        return None
+
+    async def save_offset(offset):
+        pass
+
+    async def handler(update):
+        await release.wait()
+
+    poller = UpdatePoller(tg, handler, load_offset, save_offset, max_pending=2)
+    task = asyncio.create_task(poller.run())
+    for _ in range(100):
+        await asyncio.sleep(0)
+    assert tg.offsets == [None]
+
+    release.set()
+    for _ in range(1000):
+        if len(tg.offsets) == 3:
+            break
+        await asyncio.sleep(0)
+    assert tg.offsets == [None, 3, 4]
+
+    poller.stop()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
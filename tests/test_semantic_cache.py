@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import httpx
+import orjson
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from app.apifree_client import ApiFreeClient  # noqa: E402
+from app.semantic_cache import SemanticCache, exact_key, normalize_prompt  # noqa: E402
+
+MODEL = "openai/gpt-5-mini"
+
+
+def test_normalize_keeps_numbers_and_operators():
+    assert normalize_prompt("Что ты умеешь?!") == "что умеешь"
+    assert normalize_prompt("Сколько будет 2+2?") == "сколько будет 2+2"
+    assert normalize_prompt("переведи 1,5 или 100/300 $") == "переведи 1,5 или 100/300"
+    assert exact_key(normalize_prompt("2+2")) != exact_key(normalize_prompt("2-2"))
+    # a hyphenated word carries no operator
+    assert exact_key(normalize_prompt("что-то")) == exact_key(normalize_prompt("что то")) == 0
+
+
+@pytest.mark.parametrize("query", ["что ты умеешь?", "Что ты умеешь", "ЧТО ТЫ УМЕЕШЬ!!", "Что умеешь"])
+def test_near_duplicates_hit(query):
+    cache = SemanticCache(capacity=100)
+    cache.put(MODEL, "что ты умеешь", "чат, фото, видео")
+    assert cache.lookup(MODEL, query) == "чат, фото, видео"
+
+
+@pytest.mark.parametrize("stored, query", [
+    ("сколько будет 2+2?", "сколько будет 2-2?"),
+    ("сколько будет 1234*5678", "сколько будет 1234*5679"),
+    ("переведи 100 долларов в рубли", "переведи 300 долларов в рубли"),
+    ("переведи 100/300 долларов", "переведи 100/301 долларов"),
+    ("напиши стих про кота", "напиши стих про собаку"),
+])
+def test_different_prompts_miss(stored, query):
+    cache = SemanticCache(capacity=100)
+    cache.put(MODEL, stored, "answer")
+    assert cache.lookup(MODEL, stored) == "answer"
+    assert cache.lookup(MODEL, query) is None
+
+
+def test_answers_are_per_model():
+    cache = SemanticCache(capacity=100, models=[MODEL])
+    cache.put(MODEL, "привет", "hi")
+    assert cache.accepts(MODEL)
+    assert not cache.accepts("openai/gpt-5.2")
+    assert cache.lookup("google/gemini-2.5-flash", "привет") is None
+
+
+def test_lru_eviction():
+    cache = SemanticCache(capacity=3)
+    cache.put(MODEL, "напиши стих про кота", "cat")
+    cache.put(MODEL, "рецепт борща", "borsch")
+    cache.put(MODEL, "расскажи анекдот", "joke")
+    assert cache.lookup(MODEL, "напиши стих про кота") == "cat"  # now the most recent
+
+    cache.put(MODEL, "идея для бизнеса", "idea")
+
+    assert len(cache) == 3
+    assert cache.lookup(MODEL, "рецепт борща") is None
+    assert cache.lookup(MODEL, "напиши стих про кота") == "cat"
+    assert cache.lookup(MODEL, "расскажи анекдот") == "joke"
+    assert cache.lookup(MODEL, "идея для бизнеса") == "idea"
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "cache.npz")
+    cache = SemanticCache(capacity=10, path=path)
+    cache.put(MODEL, "что ты умеешь", "чат")
+    cache.put(MODEL, "сколько будет 2+2", "4")
+    cache.put("google/gemini-2.5-flash", "привет", "hi")
+    cache.save()
+
+    restored = SemanticCache(capacity=10, path=path)
+    assert restored.load() == 3
+    assert restored.lookup(MODEL, "Что умеешь?") == "чат"
+    assert restored.lookup(MODEL, "сколько будет 2+2?") == "4"
+    assert restored.lookup(MODEL, "сколько будет 2-2?") is None
+    assert restored.lookup("google/gemini-2.5-flash", "Привет!") == "hi"
+
+    # smaller capacity keeps the most recently used rows
+    small = SemanticCache(capacity=1, path=path)
+    assert small.load() == 1
+    assert small.lookup("google/gemini-2.5-flash", "привет") == "hi"
+
+
+def test_load_skips_incompatible_snapshot(tmp_path):
+    path = str(tmp_path / "cache.npz")
+    assert SemanticCache(path=path).load() == 0  # no file yet
+
+    np.savez(path, vectors=np.zeros((1, 256), dtype=np.float32), model_ids=np.zeros(1, dtype=np.int32),
+             last_used=np.ones(1, dtype=np.int64), answers=np.frombuffer(b'["a"]', dtype=np.uint8),
+             models=np.frombuffer(b'{"m":0}', dtype=np.uint8))
+    assert SemanticCache(path=path).load() == 0
+
+
+async def test_maybe_persist_respects_interval(tmp_path):
+    path = tmp_path / "cache.npz"
+    cache = SemanticCache(capacity=10, path=str(path), persist_every_s=3600)
+    cache.put(MODEL, "привет", "hi")
+    await cache.maybe_persist()
+    assert not path.exists()
+
+    cache.persist_every_s = 0
+    await cache.maybe_persist()
+    assert path.exists()
+
+
+async def test_chat_uses_cache_for_one_shot_prompts():
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        body = orjson.loads(request.content)
+        calls.append(body["messages"][-1]["content"])
+        return httpx.Response(200, json={"choices": [{"message": {"content": f"answer {len(calls)}"}}]})
+
+    client = ApiFreeClient("https://api.example", "key", semantic_cache=SemanticCache(capacity=10, models=[MODEL]))
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    one_shot = lambda text: [{"role": "user", "content": text}]  # noqa: E731
+    assert await client.chat(MODEL, one_shot("что ты умеешь")) == "answer 1"
+    assert await client.chat(MODEL, one_shot("Что умеешь?")) == "answer 1"
+    assert await client.chat(MODEL, one_shot("сколько будет 2+2")) == "answer 2"
+    assert await client.chat(MODEL, one_shot("сколько будет 2-2")) == "answer 3"
+    # not a cacheable model / not a one-shot prompt: always upstream
+    assert await client.chat("openai/gpt-5.2", one_shot("что ты умеешь")) == "answer 4"
+    history = [{"role": "assistant", "content": "привет"}, {"role": "user", "content": "что ты умеешь"}]
+    assert await client.chat(MODEL, history) == "answer 5"
+    assert len(calls) == 5
+    await client.aclose()
@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import asyncio
+
+import aiosqlite
+import pytest
+
+from app.storage import PostgresStorage, SQLiteStorage, asyncpg, create_storage
+
+
+async def test_get_user_missing(storage):
+    assert await storage.get_user(1) is None
+
+
+async def test_upsert_user_keeps_credits(storage):
+    await storage.upsert_user(1, "anna", "Анна", 5, None)
+    await storage.upsert_user(1, "anna_new", "Анна", 100, 7)
+
+    u = await storage.get_user(1)
+    assert (u.username, u.first_name) == ("anna_new", "Анна")
+    # credits and referrer are only set on insert
+    assert (u.credits_free, u.credits_pro, u.referred_by) == (5, 0, None)
+
+
+async def test_upsert_users_batch(storage):
+    await storage.upsert_users([(1, "a", None, 2, None), (2, None, "B", 3, 1)])
+    await storage.upsert_users([(2, "b", "B", 9, None), (3, "c", "C", 1, 2)])
+    await storage.upsert_users([])
+
+    users = [await storage.get_user(i) for i in (1, 2, 3)]
+    assert [u.credits_free for u in users] == [2, 3, 1]
+    assert users[1].username == "b"
+    assert users[1].referred_by == 1
+
+
+async def test_add_credits(storage):
+    await storage.upsert_user(1, None, None, 1, None)
+    await storage.add_credits(1, free_delta=2, pro_delta=3)
+    await storage.add_credits(404, free_delta=1)  # unknown user: no-op
+
+    u = await storage.get_user(1)
+    assert (u.credits_free, u.credits_pro) == (3, 3)
+    assert await storage.get_user(404) is None
+
+
+async def test_consume_credit_pro_first_then_free(storage):
+    await storage.upsert_user(1, None, None, 1, None)
+    await storage.add_credits(1, pro_delta=2)
+
+    balances = []
+    for _ in range(3):
+        assert await storage.consume_credit(1)
+        u = await storage.get_user(1)
+        balances.append((u.credits_pro, u.credits_free))
+    assert balances == [(1, 1), (0, 1), (0, 0)]
+
+    assert not await storage.consume_credit(1)
+    u = await storage.get_user(1)
+    assert (u.credits_pro, u.credits_free) == (0, 0)
+    assert not await storage.consume_credit(404)
+
+
+async def test_register_user_with_referral(storage):
+    assert await storage.register_user(1, "ref", None, 2, None, referrer_bonus=1)
+    assert await storage.register_user(2, "friend", None, 3, 1, referrer_bonus=1)
+    assert await storage.register_user(3, "friend2", None, 3, 1, referrer_bonus=1)
+
+    assert (await storage.get_user(1)).credits_free == 4
+    assert (await storage.get_user(2)).referred_by == 1
+    assert await storage.referral_count(1) == 2
+    assert await storage.top_referrers() == [(1, 2)]
+
+
+async def test_register_user_existing_changes_nothing(storage):
+    assert await storage.register_user(1, "ref", None, 2, None, referrer_bonus=1)
+    assert await storage.register_user(2, "friend", None, 3, 1, referrer_bonus=1)
+    assert not await storage.register_user(2, "again", None, 10, 1, referrer_bonus=1)
+
+    assert (await storage.get_user(1)).credits_free == 3
+    assert (await storage.get_user(2)).credits_free == 3
+    assert (await storage.get_user(2)).username == "friend"
+    assert await storage.referral_count(1) == 1
+
+
+async def test_register_user_unknown_or_self_referrer(storage):
+    assert await storage.register_user(1, None, None, 2, 1, referrer_bonus=5)
+    assert await storage.register_user(2, None, None, 2, 999, referrer_bonus=5)
+
+    assert (await storage.get_user(1)).credits_free == 2
+    assert await storage.referral_count(1) == 0
+    assert await storage.referral_count(999) == 0
+    assert await storage.top_referrers() == []
+
+
+def _reopen(storage):
+    if isinstance(storage, SQLiteStorage):
+        return SQLiteStorage(storage.db_path)
+    return PostgresStorage(storage.dsn, min_size=1, max_size=2)
+
+
+async def test_referral_stats_backfill_concurrent_init(storage):
+    # users written before referral_stats existed (upsert_users doesn't touch the stats)
+    await storage.upsert_users([(1, None, None, 0, None), (2, None, None, 0, 1), (3, None, None, 0, 1),
+                                (4, None, None, 0, 4), (5, None, None, 0, 999)])
+    assert await storage.referral_count(1) == 0
+
+    # two workers booting at once: both see empty stats, neither may fail
+    workers = [_reopen(storage), _reopen(storage)]
+    await asyncio.gather(*(w.init() for w in workers))
+    for w in workers:
+        await w.close()
+
+    assert await storage.referral_count(1) == 2
+    assert await storage.top_referrers() == [(1, 2)]
+
+
+async def test_state(storage):
+    assert await storage.get_state("updates_offset") is None
+    await storage.set_state("updates_offset", "10")
+    await storage.set_state("updates_offset", "11")
+    assert await storage.get_state("updates_offset") == "11"
+
+
+async def test_profile_with_jobs_missing_user(storage):
+    assert await storage.profile_with_jobs(1) == (None, [])
+
+
+async def test_profile_with_jobs_without_jobs(storage):
+    await storage.upsert_user(1, "a", None, 2, None)
+    user, jobs = await storage.profile_with_jobs(1)
+    assert user.tg_id == 1
+    assert jobs == []
+
+
+async def test_jobs(storage):
+    await storage.upsert_user(1, "a", None, 2, None)
+    first = await storage.create_job(1, "image", "r1", "queuing", upstream="https://b.example#KEY2")
+    second = await storage.create_job(1, "video", "r2", "queuing")
+    await storage.create_job(2, "image", "r1", "queuing")  # same id from another user
+
+    job = await storage.get_job(1, "r1")
+    assert (job["id"], job["kind"], job["status"], job["upstream"]) == (first, "image", "queuing", "https://b.example#KEY2")
+    assert (await storage.get_job(1, "r2"))["upstream"] is None
+    assert await storage.get_job(1, "nope") is None
+
+    await storage.set_job_status(first, "done")
+    assert (await storage.get_job(1, "r1"))["status"] == "done"
+    _, jobs = await storage.profile_with_jobs(1)
+    assert [j["id"] for j in jobs] == [second]
+
+
+async def test_sqlite_migrates_jobs_without_upstream(tmp_path):
+    path = str(tmp_path / "old.db")
+    async with aiosqlite.connect(path) as db:
+        await db.execute("""
+            CREATE TABLE jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                request_id TEXT,
+                status TEXT NOT NULL,
+                payload_json TEXT,
+                created_at TEXT NOT NULL
+            )""")
+        await db.execute("INSERT INTO jobs (tg_id, kind, request_id, status, created_at) VALUES (1, 'image', 'old', 'queuing', '')")
+        await db.commit()
+
+    storage = SQLiteStorage(path)
+    await storage.init()
+    await storage.init()  # idempotent
+    assert (await storage.get_job(1, "old"))["upstream"] is None
+    await storage.create_job(1, "image", "new", "queuing", upstream="u")
+    assert (await storage.get_job(1, "new"))["upstream"] == "u"
+    await storage.close()
+
+
+async def test_recipients_keyset_skips_blocked(storage):
+    await storage.upsert_users([(i, None, None, 0, None) for i in range(1, 11)])
+    await storage.mark_blocked([3, 4])
+    await storage.mark_blocked([4])  # idempotent
+    await storage.mark_blocked([])
+
+    assert await storage.recipients_after(0, 3) == [1, 2, 5]
+    assert await storage.recipients_after(5, 100) == [6, 7, 8, 9, 10]
+    assert await storage.recipients_after(10, 100) == []
+    assert await storage.count_recipients_after(0) == 8
+    assert await storage.count_recipients_after(5) == 5
+
+    await storage.unblock_user(3)
+    assert await storage.recipients_after(0, 3) == [1, 2, 3]
+
+
+async def test_broadcast_checkpoint(storage):
+    b = await storage.create_broadcast(42, "hello", owner="w1", lease_s=60)
+    assert (b.admin_id, b.text, b.status, b.last_tg_id, b.owner) == (42, "hello", "running", 0, "w1")
+    assert (b.sent, b.failed, b.blocked, b.progress_message_id) == (0, 0, 0, None)
+    other = await storage.create_broadcast(42, "second", owner="w1", lease_s=60)
+
+    b.last_tg_id, b.sent, b.failed, b.blocked, b.progress_message_id = 500, 480, 5, 15, 77
+    assert await storage.save_broadcast(b, lease_s=60) == "running"
+    running = await storage.running_broadcasts()
+    assert [r.id for r in running] == [b.id, other.id]
+    assert running[0].last_tg_id == 500
+    assert (running[0].sent, running[0].failed, running[0].blocked, running[0].progress_message_id) == (480, 5, 15, 77)
+
+    b.status = "done"
+    assert await storage.save_broadcast(b) == "done"
+    assert [r.id for r in await storage.running_broadcasts()] == [other.id]
+    assert (await storage.get_broadcast(b.id)).status == "done"
+    assert await storage.get_broadcast(404) is None
+
+
+async def test_broadcast_lease(storage):
+    b = await storage.create_broadcast(42, "hello", owner="w1", lease_s=60)
+
+    assert await storage.claim_broadcast(b.id, "w2", lease_s=60) is None
+    renewed = await storage.claim_broadcast(b.id, "w1", lease_s=120)
+    assert renewed.owner == "w1" and renewed.lease_until > b.lease_until
+
+    # only the owner checkpoints
+    stolen = await storage.get_broadcast(b.id)
+    stolen.owner, stolen.sent = "w2", 10
+    assert await storage.save_broadcast(stolen) is None
+    assert (await storage.get_broadcast(b.id)).sent == 0
+
+    expired = await storage.create_broadcast(42, "old", owner="dead", lease_s=-1)
+    taken = await storage.claim_broadcast(expired.id, "w2", lease_s=60)
+    assert taken.owner == "w2"
+    assert await storage.claim_broadcast(expired.id, "dead", lease_s=60) is None
+
+
+async def test_cancel_broadcasts_is_kept(storage):
+    b = await storage.create_broadcast(42, "hello", owner="w1", lease_s=60)
+    done = await storage.create_broadcast(42, "done", owner="w1", lease_s=60)
+    done.status = "done"
+    await storage.save_broadcast(done)
+
+    assert await storage.cancel_broadcasts() == 1
+    assert await storage.cancel_broadcasts() == 0
+
+    # the owner's next checkpoint learns about it and can't flip it back
+    b.sent = 3
+    assert await storage.save_broadcast(b, lease_s=60) == "cancelled"
+    stored = await storage.get_broadcast(b.id)
+    assert (stored.status, stored.sent) == ("cancelled", 3)
+    assert await storage.claim_broadcast(b.id, "w1", lease_s=60) is None
+    assert await storage.running_broadcasts() == []
+
+
+def test_create_storage_picks_backend(tmp_path):
+    assert isinstance(create_storage("", str(tmp_path / "a.db")), SQLiteStorage)
+    if asyncpg is None:
+        with pytest.raises(RuntimeError):
+            create_storage("postgresql://u@localhost/db")
+    else:
+        assert isinstance(create_storage("postgres://u@localhost/db"), PostgresStorage)
@@ -4,15 +4,11 @@ if (tg) tg.ready();
 function qs(id){ return document.getElementById(id); }
 function setBadge(text){ qs("statusBadge").textContent = text; }
 
-function getTgId(){
-  const id = tg?.initDataUnsafe?.user?.id;
-  return id ? Number(id) : null;
-}
-
 async function api(path, opts={}){
+  // initData identifies the user on every call (bootstrap, job submit/result)
   const r = await fetch(path, {
-    headers: { "Content-Type":"application/json" },
-    ...opts
+    ...opts,
+    headers: { "Content-Type":"application/json", "X-Telegram-Init-Data": tg?.initData || "" }
   });
   const ct = r.headers.get("content-type") || "";
   const data = ct.includes("application/json") ? await r.json() : await r.text();
@@ -24,32 +20,42 @@ function fillSelect(sel, items){
   sel.innerHTML = "";
   for (const it of items){
     const opt = document.createElement("option");
-    opt.value = it.id;
-    opt.textContent = it.title || it.id;
+    const id = typeof it === "string" ? it : it.id;
+    opt.value = id;
+    opt.textContent = it.title || id;
     sel.appendChild(opt);
   }
 }
 
+const JOB_OUT = { image: "imageOut", video: "videoOut", music: "musicOut" };
+
 async function init(){
   try{
     setBadge("Loading…");
 
-    const models = await api("/api/models");
+    // one round trip: models + profile + unfinished jobs
+    const boot = await api("/api/bootstrap");
+    const models = boot.models || {};
     fillSelect(qs("chatModel"), models.chat || []);
     fillSelect(qs("imageModel"), models.image || []);
     fillSelect(qs("videoModel"), models.video || []);
     fillSelect(qs("musicModel"), models.music || []);
 
-    const tgId = getTgId();
-    if (!tgId){
+    const me = boot.me;
+    if (!me){
       qs("userLine").textContent = "Telegram ID не найден (открой Mini App из Telegram)";
       setBadge("NO TG");
     } else {
-      const me = await api(`/api/me?tg_id=${tgId}`);
-      qs("userLine").textContent = `tg_id: ${me.tg_id} • free: ${me.free_credits} • pro: ${me.pro_credits}`;
+      qs("userLine").textContent = `tg_id: ${me.tg_id} • free: ${me.free} • pro: ${me.pro}`;
       setBadge("OK");
     }
 
+    // resume polling for jobs started in a previous session
+    for (const job of boot.jobs || []){
+      const outId = JOB_OUT[job.kind];
+      if (outId) pollResult(job.kind, job.request_id || job.id, qs(outId));
+    }
+
   }catch(e){
     console.error(e);
     qs("userLine").textContent = "Ошибка загрузки: " + e.message;